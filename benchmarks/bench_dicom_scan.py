@@ -0,0 +1,54 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dicom_index import read_dicom_headers, scan_tags
+
+def bench(files, tags, header_only, jobs=1, backend='thread'):
+
+    start = time.perf_counter()
+    headers = read_dicom_headers(files, tags, header_only=header_only, jobs=jobs, backend=backend)
+    read = len([h for f, h, e in headers if h is not None])
+
+    elapsed = time.perf_counter() - start
+    return read, elapsed
+
+def main(args):
+
+    files = [f for f in glob.glob(os.path.join(args.dir, '**'), recursive=True) if Path(f).is_file()]
+    tags = scan_tags(args.scan_tags)
+
+    print("Files:", len(files))
+    print("Tags:", ", ".join(tags))
+
+    # The modes are alternated so all of them see the same state of the file system cache
+    modes = [('full', False, 1, 'thread'), ('header_only', True, 1, 'thread')]
+    if args.jobs > 1:
+        modes += [('threads_{}'.format(args.jobs), True, args.jobs, 'thread'), ('processes_{}'.format(args.jobs), True, args.jobs, 'process')]
+
+    results = {mode[0]: [] for mode in modes}
+    for r in range(args.repeat):
+        for mode, header_only, jobs, backend in modes:
+            results[mode].append(bench(files, tags, header_only, jobs, backend))
+
+    print("{:<14} {:>8} {:>10} {:>12}".format('mode', 'dicoms', 'seconds', 'files/s'))
+    for mode, runs in results.items():
+        read, elapsed = min(runs, key=lambda r: r[1])
+        print("{:<14} {:>8} {:>10.3f} {:>12.1f}".format(mode, read, elapsed, read/elapsed if elapsed > 0 else 0))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare full dicom reads against header only, tag limited reads used by dicom_dir_split')
+    parser.add_argument('--dir', type=str, required=True, help='Input directory with DICOM files')
+    parser.add_argument('--scan_tags', default=None, type=str, nargs='+', help='Additional dicom tags to read')
+    parser.add_argument('--jobs', default=1, type=int, help='Also benchmark the thread and process pools with this number of workers')
+    parser.add_argument('--repeat', default=3, type=int, help='Number of repetitions, the best time is reported')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,105 @@
+import argparse
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from scan_matcher import ScanMatcher
+from synthetic_dicom import SERIES_DESCRIPTIONS, pattern_search_scans
+
+# Variants seen in real cohorts, the same protocol renamed by site or scanner software version
+VARIANTS = ['{sd}', '{sd}_2', '{sd}_repeat', 'ABCD_{sd}', '{sd}_ND', '{sd}_MoCo', 'SITE{site}_{sd}', '{sd} (V{site})']
+
+def cohort(sessions, unique, seed=0):
+    """Series descriptions of the sessions of a synthetic cohort, about unique different strings that repeat across sessions.
+    Returns a list with the {(sn, sd): sd} dictionary of each session"""
+
+    rng = np.random.RandomState(seed)
+    names = set()
+    site = 0
+    while len(names) < unique:
+        for variant in VARIANTS:
+            for sd in SERIES_DESCRIPTIONS:
+                names.add(variant.format(sd=sd, site=site))
+        site += 1
+    names = sorted(names)[:unique]
+
+    cohort = []
+    for s in range(sessions):
+        chosen = rng.choice(len(names), size=len(SERIES_DESCRIPTIONS), replace=False)
+        cohort.append({(i + 1, names[n]): names[n] for i, n in enumerate(chosen)})
+    return cohort
+
+def loop_classify(rows, series_description):
+    # Classification as done by convert before the ScanMatcher, every pattern evaluated with re.match for every series,
+    # the rules grouped by scan
+    matches = {sn_sd: [] for sn_sd in series_description}
+    for idx, row in sorted(enumerate(rows), key=lambda r: r[1]['scan']):
+        for sn_sd in sorted(series_description):
+            if re.match(row['match'], series_description[sn_sd], re.IGNORECASE):
+                matches[sn_sd].append(idx)
+    return matches
+
+def matcher_classify(matcher):
+    def classify(rows, series_description):
+        classification = matcher.classify(series_description)
+        return {sn_sd: [rule['index'] for rule in rules] for sn_sd, rules in classification['matches'].items()}
+    return classify
+
+def bench(classify, rows, sessions):
+
+    start = time.perf_counter()
+    results = [classify(rows, series_description) for series_description in sessions]
+    elapsed = time.perf_counter() - start
+
+    return results, elapsed
+
+def main(args):
+
+    rows = pattern_search_scans()
+    sessions = cohort(args.sessions, args.unique)
+    series = sum(len(s) for s in sessions)
+
+    print("Sessions:", len(sessions), "Series:", series, "Unique descriptions:", len(set(sd for s in sessions for sd in s.values())))
+
+    # A new matcher for each repetition so the cache starts empty, shared by all the sessions as in --csv mode
+    modes = [
+        ('loop', lambda: loop_classify),
+        ('compiled', lambda: matcher_classify(ScanMatcher(rows, cache_size=0, prefilter=False))),
+        ('prefilter', lambda: matcher_classify(ScanMatcher(rows, cache_size=0))),
+        ('prefilter_lru', lambda: matcher_classify(ScanMatcher(rows, cache_size=args.cache_size)))
+    ]
+
+    reference = None
+    timings = {}
+    for r in range(args.repeat):
+        for mode, make in modes:
+            results, elapsed = bench(make(), rows, sessions)
+            if reference is None:
+                reference = results
+            elif results != reference:
+                print("ERROR: the classification of", mode, "differs from the loop", file=sys.stderr)
+                sys.exit(1)
+            timings.setdefault(mode, []).append(elapsed)
+
+    print("{:<14} {:>10} {:>14} {:>9}".format('mode', 'seconds', 'series/s', 'speedup'))
+    loop = min(timings['loop'])
+    for mode, runs in timings.items():
+        elapsed = min(runs)
+        print("{:<14} {:>10.4f} {:>14.1f} {:>8.1f}x".format(mode, elapsed, series/elapsed if elapsed > 0 else 0, loop/elapsed if elapsed > 0 else 0))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare the classification of series descriptions by the pattern loop, the compiled ScanMatcher, the literal prefilter and the LRU cache on a synthetic cohort')
+    parser.add_argument('--sessions', default=2000, type=int, help='Number of sessions of the cohort')
+    parser.add_argument('--unique', default=300, type=int, help='Number of different series descriptions in the cohort')
+    parser.add_argument('--cache_size', default=4096, type=int, help='Size of the LRU cache of the matcher')
+    parser.add_argument('--repeat', default=3, type=int, help='Number of repetitions, the best time is reported')
+
+    args = parser.parse_args()
+
+    main(args)
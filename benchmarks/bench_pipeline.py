@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import stat
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pydicom
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from profiling import STAGES
+from scan_matcher import ScanMatcher
+from synthetic_dicom import SERIES_DESCRIPTIONS, generate_session, pattern_search_scans, uncovered_rules
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DCM_TO_BIDS = os.path.join(BENCH_DIR, '..', 'dcm_to_bids.py')
+
+def stub_converter(tmp_dir):
+    # Wrapper script so the stub runs with the same interpreter as the benchmark
+    wrapper = os.path.join(tmp_dir, 'dcm2niix')
+    with open(wrapper, 'w') as f:
+        f.write('#!/bin/sh\nexec "{python}" "{stub}" "$@"\n'.format(python=sys.executable, stub=os.path.join(BENCH_DIR, 'stub_dcm2niix.py')))
+    os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IEXEC)
+    return wrapper
+
+def bench_matching(descriptions, repeat):
+    # Classification of all the series of the session, repeated to get a measurable time. Without the cache, it would
+    # only measure the lookups after the first repetition (see bench_matching.py)
+    matcher = ScanMatcher(pattern_search_scans(), cache_size=0)
+    series_description = {(i + 1, sd): sd for i, sd in enumerate(descriptions)}
+
+    start = time.perf_counter()
+    for r in range(repeat):
+        matcher.classify(series_description)
+    elapsed = time.perf_counter() - start
+
+    return {'series_per_second': len(series_description)*repeat/elapsed if elapsed > 0 else 0}
+
+def bench_pipeline(args, data_dir, tmp_dir, converter):
+    """Run dcm_to_bids.py on the session with the stub converter and return the metrics of each run"""
+
+    runs = []
+
+    for r in range(args.repeat):
+
+        out_bids = os.path.join(tmp_dir, 'bids_{}'.format(r))
+        metrics_out = os.path.join(tmp_dir, 'metrics_{}'.format(r))
+
+        cmd = [sys.executable, DCM_TO_BIDS, '--dir', data_dir, '--out_bids', out_bids, '--dcm2niix', converter, '--metrics_out', metrics_out,
+            '--bids_pid', 'bench', '--bids_age', str(r), '--jobs', str(args.jobs), '--convert_jobs', str(args.convert_jobs), '--stream', str(args.stream)]
+        if args.out_dcm:
+            cmd += ['--out_dcm', os.path.join(tmp_dir, 'dcm_{}'.format(r))]
+
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+        wall = time.perf_counter() - start
+
+        with open(os.path.join(metrics_out, 'sub-bench_ses-{}_metrics.json'.format(r))) as f:
+            metrics = json.load(f)
+        metrics['wall_seconds'] = wall
+        runs.append(metrics)
+
+    return runs
+
+def report(args, runs, matching, files):
+
+    results = {'wall_seconds': statistics.median(r['wall_seconds'] for r in runs), 'stages': {}}
+
+    for name in STAGES:
+        seconds = [r['stages'][name]['seconds'] for r in runs if name in r['stages']]
+        if len(seconds) > 0:
+            results['stages'][name] = {'seconds': statistics.median(seconds)}
+
+    # With --stream the files are read in the stream stage
+    scan_stage = 'stream' if args.stream else 'dicom_dir_split'
+    split_seconds = results['stages'][scan_stage]['seconds']
+    results['stages'][scan_stage]['files_per_second'] = files/split_seconds if split_seconds > 0 else 0
+    results['matching'] = matching
+
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    results['peak_rss_mb'] = maxrss/1024.0 if sys.platform != 'darwin' else maxrss/1024.0/1024.0
+
+    return results
+
+def main(args):
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_dcm_to_bids_', dir=args.tmp_dir)
+
+    try:
+        if args.data is not None:
+            data_dir = args.data
+            descriptions = SERIES_DESCRIPTIONS
+        else:
+            data_dir = os.path.join(tmp_dir, 'dicom')
+            generated = generate_session(data_dir, series=args.series, files=args.files, pixels=args.pixels, depth=args.depth)
+            descriptions = [sd for sn, sd in generated]
+            for rule in uncovered_rules(descriptions):
+                print("WARNING: no series matches the rule", rule['scan'], rule['match'], file=sys.stderr)
+
+        files = sum(len(fs) for root, dirs, fs in os.walk(data_dir))
+
+        converter = stub_converter(tmp_dir)
+        runs = bench_pipeline(args, data_dir, tmp_dir, converter)
+        matching = bench_matching(descriptions, args.match_repeat)
+
+        results = report(args, runs, matching, files)
+
+    finally:
+        if not args.keep:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            print("Kept:", tmp_dir)
+
+    print("files: {files}, series: {series}, pixels: {pixels}, depth: {depth}, runs: {repeat}".format(files=files, series=args.series, pixels=args.pixels, depth=args.depth, repeat=args.repeat))
+    print("{:<26} {:>10} {:>12}".format('stage', 'seconds', 'rate'))
+    for name, stage in results['stages'].items():
+        rate = "{:.1f} files/s".format(stage['files_per_second']) if 'files_per_second' in stage else ''
+        print("{:<26} {:>10.3f} {:>12}".format(name, stage['seconds'], rate))
+    print("{:<26} {:>10} {:>12}".format('matching', '', "{:.1f} series/s".format(results['matching']['series_per_second'])))
+    print("{:<26} {:>10.3f}".format('wall', results['wall_seconds']))
+    print("{:<26} {:>10.1f} MB".format('peak_rss', results['peak_rss_mb']))
+
+    if args.out is not None:
+        # Parameters and versions are saved with the numbers so results from different runs can be compared
+        out = {
+            'params': {k: v for k, v in vars(args).items() if k not in ['out', 'tmp_dir', 'keep']},
+            'files': files,
+            'python': platform.python_version(),
+            'pydicom': pydicom.__version__,
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results
+        }
+        with open(args.out, 'w') as f:
+            json.dump(out, f, indent=4)
+        print("Writing:", args.out)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark dcm_to_bids.py on a synthetic dicom session with a stub converter in place of dcm2niix. Runs offline')
+    parser.add_argument('--series', default=len(SERIES_DESCRIPTIONS), type=int, help='Number of series of the synthetic session')
+    parser.add_argument('--files', default=100, type=int, help='Number of files per series')
+    parser.add_argument('--pixels', default=128, type=int, help='Rows and columns of each image')
+    parser.add_argument('--depth', default=1, type=int, help='Directory depth of the series directories')
+    parser.add_argument('--data', default=None, type=str, help='Use an existing dicom directory instead of generating one')
+    parser.add_argument('--repeat', default=3, type=int, help='Number of pipeline runs, the median is reported')
+    parser.add_argument('--match_repeat', default=1000, type=int, help='Number of times the series are classified in the matching benchmark')
+    parser.add_argument('--jobs', default=1, type=int, help='--jobs passed to dcm_to_bids.py')
+    parser.add_argument('--convert_jobs', default=1, type=int, help='--convert_jobs passed to dcm_to_bids.py')
+    parser.add_argument('--stream', default=0, type=int, help='--stream passed to dcm_to_bids.py, compare peak_rss with and without it')
+    parser.add_argument('--out_dcm', default=0, type=int, help='Create the split directories (--out_dcm) instead of temporary ones')
+    parser.add_argument('--tmp_dir', default=None, type=str, help='Directory for the session and outputs')
+    parser.add_argument('--keep', default=0, type=int, help='Keep the generated session and outputs')
+    parser.add_argument('--out', default=None, type=str, help='Write the results as json to this file')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from synthetic_dicom import generate_session
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DCM_TO_BIDS = os.path.join(BENCH_DIR, '..', 'dcm_to_bids.py')
+DICOM_DIR_SPLIT = os.path.join(BENCH_DIR, '..', 'dicom_dir_split.py')
+
+# Packages that are slow to import, the table reports which of them each command loads
+HEAVY_MODULES = ['pandas', 'pydicom', 'numpy', 'nibabel', 'asyncio']
+
+def commands(data_dir, index_dir):
+    """Commands timed, each one in a new interpreter. The imports the scripts used to do at startup (pandas and pydicom)
+    are timed alone as a reference"""
+
+    python = sys.executable
+    return [
+        ('python', [python, '-c', 'pass']),
+        ('import pandas, pydicom', [python, '-c', 'import pandas, pydicom']),
+        ('dcm_to_bids --help', [python, DCM_TO_BIDS, '--help']),
+        ('dicom_dir_split --help', [python, DICOM_DIR_SPLIT, '--help']),
+        ('classify_only', [python, DCM_TO_BIDS, '--dir', data_dir, '--classify_only', '1']),
+        ('classify_only (index)', [python, DCM_TO_BIDS, '--dir', data_dir, '--classify_only', '1', '--index_dir', index_dir])
+    ]
+
+def loaded_modules(cmd):
+    # Top level packages imported by the command, from the -X importtime report of the interpreter
+    proc = subprocess.run([cmd[0], '-X', 'importtime'] + cmd[1:], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            modules.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return [module for module in HEAVY_MODULES if module in modules]
+
+def bench(cmd, repeat):
+
+    seconds = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        seconds.append(time.perf_counter() - start)
+
+    return {'best': min(seconds), 'median': statistics.median(seconds)}
+
+def main(args):
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_startup_', dir=args.tmp_dir)
+    results = []
+
+    try:
+        data_dir = os.path.join(tmp_dir, 'dicom')
+        index_dir = os.path.join(tmp_dir, 'index')
+        generate_session(data_dir, series=args.series, files=args.files, pixels=16)
+
+        cmds = commands(data_dir, index_dir)
+
+        # The header index is filled once so the timed runs only read it
+        subprocess.run(cmds[-1][1], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+        print("{:<24} {:>10} {:>10}  {}".format('command', 'best_s', 'median_s', 'imports'))
+        for name, cmd in cmds:
+            result = bench(cmd, args.repeat)
+            result['command'] = name
+            result['imports'] = loaded_modules(cmd)
+            results.append(result)
+            print("{:<24} {:>10.3f} {:>10.3f}  {}".format(name, result['best'], result['median'], ", ".join(result['imports'])))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump({'python': sys.version, 'series': args.series, 'files': args.files, 'repeat': args.repeat, 'results': results}, f, indent=4)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure the startup time of dcm_to_bids.py and dicom_dir_split.py, each command runs in a new interpreter as the per subject jobs of a scheduler do')
+    parser.add_argument('--series', default=3, type=int, help='Number of series of the synthetic session used by --classify_only')
+    parser.add_argument('--files', default=2, type=int, help='Number of files per series')
+    parser.add_argument('--repeat', default=10, type=int, help='Number of runs of each command, the best and median times are reported')
+    parser.add_argument('--tmp_dir', default=None, type=str, help='Directory for the synthetic session')
+    parser.add_argument('--out', default=None, type=str, help='Save the results to this json file')
+
+    args = parser.parse_args()
+
+    main(args)
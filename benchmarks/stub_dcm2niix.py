@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Stand-in for dcm2niix used by the benchmarks. It accepts the same command line used by dcm_to_bids.py
+(-e, -b, -o and the input directory), reads the header of one dicom of the series and writes a small image
+and a json sidecar named like dcm2niix would (<folder>_<protocol>_<time>_<series>). No image is actually converted"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+
+from pydicom import dcmread
+
+def main(args):
+
+    files = sorted(os.listdir(args.dir))
+    if len(files) == 0:
+        print("No dicom files found in", args.dir, file=sys.stderr)
+        return 1
+
+    ds = dcmread(os.path.join(args.dir, files[0]), stop_before_pixels=True)
+
+    name = "{folder}_{protocol}_{time}_{series}".format(folder=os.path.basename(args.dir), protocol=ds.get('ProtocolName', ''), time=ds.get('AcquisitionTime', ''), series=ds.get('SeriesNumber', ''))
+    name = name.replace(' ', '_')
+
+    acquisition_time = str(ds.get('AcquisitionTime', ''))
+    sidecar = {
+        'Modality': str(ds.get('Modality', 'MR')),
+        'SeriesNumber': int(ds.get('SeriesNumber', 0)),
+        'SeriesDescription': str(ds.get('SeriesDescription', '')),
+        'ProtocolName': str(ds.get('ProtocolName', '')),
+        'AcquisitionTime': ':'.join([acquisition_time[0:2], acquisition_time[2:4], acquisition_time[4:]])
+    }
+
+    if args.b in ['y', 'o']:
+        with open(os.path.join(args.o, name + '.json'), 'w') as f:
+            json.dump(sidecar, f, indent=4)
+
+    if args.b != 'o':
+        if args.e == 'y':
+            with open(os.path.join(args.o, name + '.nrrd'), 'w') as f:
+                f.write("NRRD0004\n")
+        else:
+            with gzip.open(os.path.join(args.o, name + '.nii.gz'), 'wb') as f:
+                f.write(bytes(352))
+
+    print("Stub conversion:", args.dir, '->', os.path.join(args.o, name), "({n} files)".format(n=len(files)))
+    return 0
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='dcm2niix stand-in for benchmarks')
+    parser.add_argument('-e', default='n', type=str, help='y to write nrrd')
+    parser.add_argument('-b', default='y', type=str, help='y to write a json sidecar, o to write only the sidecar')
+    parser.add_argument('-o', required=True, type=str, help='Output directory')
+    parser.add_argument('dir', type=str, help='Input dicom directory')
+
+    args = parser.parse_args()
+
+    sys.exit(main(args))
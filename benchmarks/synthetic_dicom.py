@@ -0,0 +1,144 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from csv_rows import read_rows
+from scan_matcher import ScanMatcher
+
+# Series descriptions used for the synthetic sessions. Together they match every rule of pattern_search_scans.csv,
+# the last ones do not match any rule, as the localizers and derived series found in real sessions
+SERIES_DESCRIPTIONS = [
+    'T1w_MPR',
+    'T2w_SPC',
+    'dMRI_6shell_AP',
+    'dMRI_6shell_PA',
+    'dMRI_dir79_AP',
+    'dMRI_dir79_PA',
+    'rfMRI_REST_AP',
+    'rfMRI_REST_PA',
+    'rfMRI_REST_AP_SBRef',
+    'rfMRI_REST_PA_SBRef',
+    'SpinEchoFieldMap_AP',
+    'SpinEchoFieldMap_PA',
+    'AAHead_Scout',
+    'dMRI_dir79_AP_SBRef',
+    'dMRI_dir79_AP_TRACEW'
+]
+
+def pattern_search_scans():
+    return read_rows(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pattern_search_scans.csv'))
+
+def uncovered_rules(descriptions, rows=None):
+    # Returns the rules of pattern_search_scans.csv that none of the descriptions match
+    if rows is None:
+        rows = pattern_search_scans()
+    matcher = ScanMatcher(rows)
+    matched = set(rule['index'] for sd in descriptions for rule in matcher.match(sd))
+    return [rule for rule in matcher.rules if rule['index'] not in matched]
+
+def save_dicom(ds, filename):
+    # pydicom < 3 needs the encoding on the dataset, newer versions take it from the transfer syntax
+    if int(pydicom.__version__.split('.')[0]) < 3:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(filename, write_like_original=False)
+    else:
+        ds.save_as(filename, enforce_file_format=True)
+
+def series_dir(out_dir, sn, sd, depth):
+    # depth 0 puts all the files in out_dir, otherwise the series directory is depth levels below out_dir
+    if depth == 0:
+        return out_dir
+    levels = ["level{}".format(i) for i in range(depth - 1)]
+    return os.path.join(out_dir, *levels, "{sn:03d}_{sd}".format(sn=sn, sd=sd))
+
+def generate_session(out_dir, series=len(SERIES_DESCRIPTIONS), files=20, pixels=64, depth=1, patient_id='SYNTH01', patient_age='012M', seed=0):
+    """Write a synthetic dicom session with the given number of series and files per series. The series descriptions
+    cycle through SERIES_DESCRIPTIONS. Returns the list of (series_number, series_description)"""
+
+    rng = np.random.RandomState(seed)
+    generated = []
+
+    for s in range(series):
+
+        sn = s + 1
+        sd = SERIES_DESCRIPTIONS[s % len(SERIES_DESCRIPTIONS)]
+        series_uid = generate_uid()
+
+        out_series = series_dir(out_dir, sn, sd, depth)
+        if not os.path.exists(out_series):
+            os.makedirs(out_series)
+
+        pixel_data = rng.randint(0, 4096, size=(pixels, pixels)).astype(np.uint16)
+
+        for i in range(files):
+
+            file_meta = FileMetaDataset()
+            file_meta.MediaStorageSOPClassUID = MRImageStorage
+            file_meta.MediaStorageSOPInstanceUID = generate_uid()
+            file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+            ds = Dataset()
+            ds.file_meta = file_meta
+            ds.SOPClassUID = MRImageStorage
+            ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+            ds.Modality = 'MR'
+            ds.PatientID = patient_id
+            ds.PatientAge = patient_age
+            ds.StudyInstanceUID = '1.2.826.0.1.3680043.8.498.1'
+            ds.SeriesInstanceUID = series_uid
+            ds.SeriesNumber = sn
+            ds.SeriesDescription = sd
+            ds.ProtocolName = sd
+            ds.InstanceNumber = i + 1
+            ds.AcquisitionDate = '20220101'
+            ds.AcquisitionTime = '{:02d}{:02d}00.000000'.format(8 + sn//60, sn % 60)
+            ds.ImagePositionPatient = [0.0, 0.0, float(i)]
+            ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+            ds.PixelSpacing = [1.0, 1.0]
+            ds.SliceThickness = 1.0
+            ds.RescaleSlope = 1.0
+            ds.RescaleIntercept = 0.0
+            ds.Rows = pixels
+            ds.Columns = pixels
+            ds.SamplesPerPixel = 1
+            ds.PhotometricInterpretation = 'MONOCHROME2'
+            ds.BitsAllocated = 16
+            ds.BitsStored = 12
+            ds.HighBit = 11
+            ds.PixelRepresentation = 0
+            ds.PixelData = pixel_data.tobytes()
+
+            # Scanner exports usually have files without extension
+            name = "IM{sn:03d}_{i:05d}".format(sn=sn, i=i) if depth == 0 else "IM{i:05d}".format(i=i)
+            save_dicom(ds, os.path.join(out_series, name))
+
+        generated.append((sn, sd))
+
+    return generated
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic dicom session whose series descriptions exercise pattern_search_scans.csv')
+    parser.add_argument('--out', type=str, required=True, help='Output directory')
+    parser.add_argument('--series', default=len(SERIES_DESCRIPTIONS), type=int, help='Number of series')
+    parser.add_argument('--files', default=20, type=int, help='Number of files per series')
+    parser.add_argument('--pixels', default=64, type=int, help='Rows and columns of each image')
+    parser.add_argument('--depth', default=1, type=int, help='Directory depth of the series directories, 0 writes all the files in --out')
+    parser.add_argument('--patient_id', default='SYNTH01', type=str, help='PatientID')
+    parser.add_argument('--patient_age', default='012M', type=str, help='PatientAge')
+
+    args = parser.parse_args()
+
+    generated = generate_session(args.out, series=args.series, files=args.files, pixels=args.pixels, depth=args.depth, patient_id=args.patient_id, patient_age=args.patient_age)
+
+    print("Generated", len(generated), "series with", args.files, "files each in", args.out)
+    for rule in uncovered_rules([sd for sn, sd in generated]):
+        print("WARNING: no series matches the rule", rule['scan'], rule['match'], file=sys.stderr)
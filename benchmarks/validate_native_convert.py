@@ -0,0 +1,124 @@
+import argparse
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+from pydicom import dcmread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dicom_convert import convert_series
+from synthetic_dicom import generate_session, save_dicom
+
+def rotation(x_degrees, z_degrees):
+    x, z = np.radians(x_degrees), np.radians(z_degrees)
+    rx = np.array([[1, 0, 0], [0, np.cos(x), -np.sin(x)], [0, np.sin(x), np.cos(x)]])
+    rz = np.array([[np.cos(z), -np.sin(z), 0], [np.sin(z), np.cos(z), 0], [0, 0, 1]])
+    return rz.dot(rx)
+
+# Geometry and scaling of each synthetic series: orientation (row and column cosines), slice spacing,
+# the slice order relative to the InstanceNumber and the rescale slope and intercept of each slice
+VARIANTS = {
+    'axial': {'orientation': [1, 0, 0, 0, 1, 0]},
+    'sagittal': {'orientation': [0, 1, 0, 0, 0, -1]},
+    'coronal': {'orientation': [1, 0, 0, 0, 0, -1]},
+    'oblique': {'orientation': list(rotation(20, 10)[:, 0]) + list(rotation(20, 10)[:, 1])},
+    'reversed': {'orientation': [1, 0, 0, 0, 1, 0], 'reverse': True},
+    'anisotropic': {'orientation': [1, 0, 0, 0, 1, 0], 'spacing': 2.5, 'pixel_spacing': [0.8, 1.2]},
+    'rescaled': {'orientation': [1, 0, 0, 0, 1, 0], 'slope': lambda i: 2.5, 'intercept': lambda i: -100.0},
+    'varying_rescale': {'orientation': [1, 0, 0, 0, 1, 0], 'slope': lambda i: 1.0 + 0.1*i, 'intercept': lambda i: float(i)}
+}
+
+def make_series(out_dir, variant, files, pixels):
+    """Write one synthetic series and change the geometry and scaling of its files as given by the variant"""
+
+    generate_session(out_dir, series=1, files=files, pixels=pixels, depth=0)
+    orientation = np.array(variant['orientation'], dtype=float)
+    normal = np.cross(orientation[0:3], orientation[3:6])
+    origin = np.array([-20.5, 13.0, 7.25])
+
+    rng = np.random.RandomState(1)
+    for i, file in enumerate(sorted(os.listdir(out_dir))):
+        filename = os.path.join(out_dir, file)
+        ds = dcmread(filename)
+        k = files - 1 - i if variant.get('reverse') else i
+        ds.ImageOrientationPatient = [round(float(v), 6) for v in orientation]
+        ds.ImagePositionPatient = [round(float(v), 4) for v in origin + normal*variant.get('spacing', 1.0)*k]
+        ds.PixelSpacing = variant.get('pixel_spacing', [1.0, 1.0])
+        ds.SliceThickness = variant.get('spacing', 1.0)
+        ds.RescaleSlope = variant.get('slope', lambda i: 1.0)(i)
+        ds.RescaleIntercept = variant.get('intercept', lambda i: 0.0)(i)
+        ds.PixelData = rng.randint(0, 4096, size=(pixels, pixels)).astype(np.uint16).tobytes()
+        save_dicom(ds, filename)
+
+def compare(native_file, dcm2niix_file):
+    # Both images in the closest RAS orientation, returns the max differences of the affines and of the voxel values
+    native = nib.as_closest_canonical(nib.load(native_file))
+    reference = nib.as_closest_canonical(nib.load(dcm2niix_file))
+    if native.shape != reference.shape:
+        return None, None, "shape {} != {}".format(native.shape, reference.shape)
+    affine_diff = np.abs(native.affine - reference.affine).max()
+    voxel_diff = np.abs(native.get_fdata() - reference.get_fdata()).max()
+    return affine_diff, voxel_diff, ''
+
+def main(args):
+
+    tmp_dir = tempfile.mkdtemp(prefix='validate_native_convert_', dir=args.tmp_dir)
+    failed = 0
+
+    print("{:<16} {:>12} {:>12} {:>14} {:>12}  {}".format('series', 'affine_diff', 'voxel_diff', 'dcm2niix_s', 'native_s', 'status'))
+
+    try:
+        for name, variant in VARIANTS.items():
+
+            dicom_dir = os.path.join(tmp_dir, name, 'dicom')
+            out_dcm2niix = os.path.join(tmp_dir, name, 'dcm2niix')
+            out_native = os.path.join(tmp_dir, name, 'native')
+            for d in [dicom_dir, out_dcm2niix, out_native]:
+                os.makedirs(d)
+
+            make_series(dicom_dir, variant, args.files, args.pixels)
+            files = sorted(glob.glob(os.path.join(dicom_dir, '*')))
+
+            start = time.perf_counter()
+            subprocess.run([args.dcm2niix, '-z', 'y', '-b', 'y', '-o', out_dcm2niix, dicom_dir], stdout=subprocess.DEVNULL, check=True)
+            dcm2niix_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            convert_series(files, out_native, name)
+            native_seconds = time.perf_counter() - start
+
+            affine_diff, voxel_diff, error = compare(os.path.join(out_native, name + '.nii.gz'), glob.glob(os.path.join(out_dcm2niix, '*.nii.gz'))[0])
+            if error == '' and (affine_diff > args.affine_tolerance or voxel_diff > args.voxel_tolerance):
+                error = 'differs'
+            failed += error != ''
+
+            print("{:<16} {:>12} {:>12} {:>14.3f} {:>12.3f}  {}".format(name, '' if affine_diff is None else "{:.2e}".format(affine_diff), '' if voxel_diff is None else "{:.2e}".format(voxel_diff), dcm2niix_seconds, native_seconds, error or 'ok'))
+    finally:
+        if args.keep:
+            print("Outputs kept in", tmp_dir)
+        else:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return 1 if failed > 0 else 0
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert synthetic single frame series (several orientations, slice orders and rescale values) with dcm2niix and with the in process converter used by --native_convert, compare the images in world space and time both')
+    parser.add_argument('--dcm2niix', default='dcm2niix', type=str, help='Executable name of dcm2niix')
+    parser.add_argument('--files', default=24, type=int, help='Number of slices of each series')
+    parser.add_argument('--pixels', default=64, type=int, help='Rows and columns of each image')
+    parser.add_argument('--affine_tolerance', default=1e-3, type=float, help='Largest accepted difference of the affines in mm')
+    parser.add_argument('--voxel_tolerance', default=1e-2, type=float, help='Largest accepted difference of the voxel values')
+    parser.add_argument('--tmp_dir', default=None, type=str, help='Directory for the series and outputs')
+    parser.add_argument('--keep', default=0, type=int, help='Keep the series and outputs')
+
+    args = parser.parse_args()
+
+    sys.exit(main(args))
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import shutil
+import signal
+import sys
+import time
+
+class ConverterRunner:
+    """Runs the converter commands (dcm2niix, DWIConvert) as asyncio subprocesses.
+    At most jobs series are converted at the same time and every call has a timeout (None waits forever). The output of
+    the calls is captured, saved to the log file of the series and printed once the call is done. A series whose
+    conversion fails or times out is converted again after a backoff that doubles on each attempt, up to retries times"""
+
+    def __init__(self, jobs=1, timeout=None, retries=0, backoff=1.0, metrics=None, stage='convert'):
+        self.jobs = max(1, jobs)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics
+        self.stage = stage
+        self.semaphore = None
+
+    def limit(self):
+        # The semaphore is created by the running loop, asyncio objects of python 3.7 are bound to the loop that creates them
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.jobs)
+        return self.semaphore
+
+    async def run_command(self, cmd, log):
+        """Run one command and return its exit code, None if it timed out. A program that cannot be started returns -1"""
+
+        start = time.perf_counter()
+
+        try:
+            # The command gets its own process group so a timeout also stops the processes it started
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        except OSError as e:
+            log.write("$ {cmd}\n{error}\n".format(cmd=' '.join(cmd), error=e))
+            print(e, file=sys.stderr)
+            return -1
+
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=self.timeout)
+            returncode = proc.returncode
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                proc.kill()
+            stdout, stderr = await proc.communicate()
+            returncode = None
+
+        seconds = time.perf_counter() - start
+        if self.metrics is not None:
+            self.metrics.subprocess(self.stage, cmd, seconds, returncode)
+
+        stdout = stdout.decode(errors='replace')
+        stderr = stderr.decode(errors='replace')
+
+        log.write("$ {cmd}\n".format(cmd=' '.join(cmd)))
+        log.write(stdout)
+        if stderr != '':
+            log.write("[stderr]\n" + stderr)
+        log.write("[{status} after {seconds:.1f} s]\n".format(status="timeout" if returncode is None else "exit code {}".format(returncode), seconds=seconds))
+        log.flush()
+
+        sys.stdout.write(stdout)
+        sys.stderr.write(stderr)
+
+        return returncode
+
+    async def run(self, commands, log_file, work_dir):
+        """Run the commands of one series in order, the caller holds a slot of limit(). The slot is given back during the
+        backoff so other series are converted meanwhile, and taken again for the retry. Before each new attempt the
+        outputs left in work_dir are removed. Returns the number of attempts, raises RuntimeError if the last one fails"""
+
+        with open(log_file, 'w') as log:
+
+            for attempt in range(self.retries + 1):
+
+                if attempt > 0:
+                    delay = self.backoff*2**(attempt - 1)
+                    log.write("Retrying in {delay:.1f} s\n".format(delay=delay))
+                    self.limit().release()
+                    try:
+                        await asyncio.sleep(delay)
+                    finally:
+                        await self.limit().acquire()
+                    for f in os.listdir(work_dir):
+                        path = os.path.join(work_dir, f)
+                        if os.path.isdir(path):
+                            shutil.rmtree(path, ignore_errors=True)
+                        else:
+                            os.remove(path)
+
+                error = None
+                for cmd in commands:
+                    returncode = await self.run_command(cmd, log)
+                    if returncode != 0:
+                        error = "{cmd} {status}".format(cmd=os.path.basename(cmd[0]), status="timed out after {} s".format(self.timeout) if returncode is None else "failed with exit code {}".format(returncode))
+                        break
+
+                if error is None:
+                    return attempt + 1
+
+                log.write(error + "\n")
+                if self.metrics is not None:
+                    self.metrics.count(self.stage, 'converter_failures')
+
+        raise RuntimeError("{error} ({attempts} attempts, see {log})".format(error=error, attempts=self.retries + 1, log=log_file))
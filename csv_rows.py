@@ -0,0 +1,15 @@
+import csv
+
+def read_rows(filename, delimiter=','):
+    """Read a small csv file (pattern_search_scans.csv, --csv_id) with the csv module instead of pandas, which is slow
+    to import. Returns a list with a dictionary per row, the values are strings and the empty cells are ''"""
+
+    with open(filename, newline='') as f:
+        return [dict(row) for row in csv.DictReader(f, delimiter=delimiter, restval='')]
+
+def write_rows(filename, rows, fieldnames, delimiter=','):
+    # Writes the rows (dictionaries) with a header line, None is written as an empty cell as pandas does
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter=delimiter, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,187 @@
+import argparse
+import filecmp
+import heapq
+import json
+import os
+import shutil
+
+from manifest import MANIFEST_NAME, ConversionManifest
+
+def parse_shard(shard):
+    # Type of the --shard option, "i/N" with 0 <= i < N
+    try:
+        i, n = [int(v) for v in shard.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("--shard must be i/N, for example 0/4")
+    if n < 1 or i < 0 or i >= n:
+        raise argparse.ArgumentTypeError("--shard i/N needs 0 <= i < N, got " + shard)
+    return i, n
+
+def balance_shards(costs, shards):
+    """Assign each item to one of the shards so the shards have about the same total cost. The items are
+    taken from the most to the least expensive and each goes to the shard with the lowest total so far.
+    Returns the shard of each item and the total cost of each shard"""
+
+    heap = [(0, shard) for shard in range(shards)]
+    assignment = [0]*len(costs)
+
+    for idx in sorted(range(len(costs)), key=lambda idx: (-costs[idx], idx)):
+        total, shard = heapq.heappop(heap)
+        assignment[idx] = shard
+        heapq.heappush(heap, (total + costs[idx], shard))
+
+    totals = [0]*shards
+    for idx, shard in enumerate(assignment):
+        totals[shard] += costs[idx]
+
+    return assignment, totals
+
+class DatasetIndex:
+    """Subjects of a --csv file with their series and estimated cost, and the shard each subject is assigned to.
+    Stored as a json file, it is built once and then read by every --shard i/N run"""
+
+    def __init__(self, subjects=None, shards=1, cost='bytes'):
+        self.subjects = subjects if subjects is not None else []
+        self.shards = shards
+        self.cost = cost
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            obj = json.load(f)
+        return cls(obj['subjects'], obj['shards'], obj['cost'])
+
+    def save(self, filename):
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'shards': self.shards, 'cost': self.cost, 'shard_costs': self.shard_costs(), 'subjects': self.subjects}, f, indent=4)
+        os.replace(tmp, filename)
+
+    def split(self, shards):
+        # Subjects that could not be scanned have no cost, they are spread as the cheapest ones
+        assignment, totals = balance_shards([s.get(self.cost, 0) for s in self.subjects], shards)
+        for subject, shard in zip(self.subjects, assignment):
+            subject['shard'] = shard
+        self.shards = shards
+        return totals
+
+    def shard_costs(self):
+        totals = [0]*self.shards
+        for subject in self.subjects:
+            totals[subject['shard']] += subject.get(self.cost, 0)
+        return totals
+
+    def select(self, df, shard):
+        """Rows of the --csv dataframe that belong to the shard. The subjects are matched by dir, bids_pid and bids_age
+        so the index must have been built from the same csv file"""
+
+        i, n = shard
+        if n != self.shards:
+            raise ValueError("The dataset index has {shards} shards, got --shard {i}/{n}".format(shards=self.shards, i=i, n=n))
+
+        keys = set((s['dir'], str(s['bids_pid']), str(s['bids_age'])) for s in self.subjects if s['shard'] == i)
+        rows = df.apply(lambda row: (row['dir'], str(row['bids_pid']), str(row['bids_age'])) in keys, axis=1)
+
+        missing = len(keys) - rows.sum()
+        if missing > 0:
+            raise ValueError("{missing} subjects of shard {i} are not in the csv file, build the dataset index again".format(missing=missing, i=i))
+
+        return df[rows]
+
+def read_scans_tsv(filename):
+    # pandas is imported by the functions that use it, dcm_to_bids.py imports this module for every subject
+    import pandas as pd
+    return pd.read_csv(filename, sep='\t', dtype=str)
+
+def merge_session(shard_session, out_session, report):
+    """Move the outputs of a session converted by one shard to the merged output. Files that already exist with the
+    same content are dropped, files with a different content are conflicts and stay in the shard directory.
+    The manifest and the scans.tsv are merged entry by entry"""
+
+    for root, dirs, files in os.walk(shard_session):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for file in sorted(files):
+
+            src = os.path.join(root, file)
+            rel = os.path.relpath(src, shard_session)
+
+            if file == MANIFEST_NAME or file.endswith('_scans.tsv'):
+                continue
+
+            dst = os.path.join(out_session, rel)
+            if os.path.exists(dst):
+                if os.path.samefile(src, dst):
+                    continue
+                if filecmp.cmp(src, dst, shallow=False):
+                    report['duplicates'] += 1
+                else:
+                    report['conflicts'].append({'file': dst, 'shard_file': src, 'reason': 'different content'})
+                continue
+
+            if not os.path.exists(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            shutil.move(src, dst)
+            report['files'] += 1
+
+    shard_manifest = ConversionManifest(os.path.join(shard_session, MANIFEST_NAME))
+    if len(shard_manifest.entries) > 0:
+        manifest = ConversionManifest(os.path.join(out_session, MANIFEST_NAME))
+        for key, entry in sorted(shard_manifest.entries.items()):
+            current = manifest.entries.get(key)
+            if current is not None and (current['fingerprint'] != entry['fingerprint'] or current['outputs'] != entry['outputs']):
+                report['conflicts'].append({'file': manifest.filename, 'shard_file': shard_manifest.filename, 'reason': 'series ' + key + ' converted differently'})
+                continue
+            manifest.record(key, entry)
+        if not os.path.samefile(os.path.dirname(manifest.filename), shard_session):
+            manifest.save()
+
+    for tsv in sorted(f for f in os.listdir(shard_session) if f.endswith('_scans.tsv')):
+
+        shard_tsv = os.path.join(shard_session, tsv)
+        out_tsv = os.path.join(out_session, tsv)
+        scans_df = read_scans_tsv(shard_tsv)
+
+        if os.path.exists(out_tsv) and not os.path.samefile(out_tsv, shard_tsv):
+            merged_df = read_scans_tsv(out_tsv)
+            acq_times = dict(zip(merged_df['filename'], merged_df['acq_time']))
+            for row in scans_df.itertuples():
+                if row.filename in acq_times and acq_times[row.filename] != row.acq_time:
+                    report['conflicts'].append({'file': out_tsv, 'shard_file': shard_tsv, 'reason': 'acq_time of ' + row.filename})
+            import pandas as pd
+            scans_df = pd.concat([merged_df, scans_df[~scans_df['filename'].isin(acq_times)]])
+
+        scans_df.to_csv(out_tsv, index=False, sep='\t')
+
+def merge_shards(shard_dirs, out_bids, df=None):
+    """Merge the bids outputs written by the --shard runs into out_bids. Returns a report with the number of sessions and
+    files merged, the conflicts (same output with a different content, series converted differently or different
+    acquisition times) and the subjects of the csv dataframe (if given) whose session is not in any shard"""
+
+    report = {'sessions': 0, 'files': 0, 'duplicates': 0, 'conflicts': [], 'missing': []}
+    sessions = {}
+
+    for shard_dir in shard_dirs:
+        for sub in sorted(os.listdir(shard_dir)):
+            if not sub.startswith('sub-') or not os.path.isdir(os.path.join(shard_dir, sub)):
+                continue
+            for ses in sorted(os.listdir(os.path.join(shard_dir, sub))):
+                if not ses.startswith('ses-'):
+                    continue
+
+                out_session = os.path.join(out_bids, sub, ses)
+                if not os.path.exists(out_session):
+                    os.makedirs(out_session)
+
+                # The same session in two shards means the shards overlap, it is merged but reported
+                sessions.setdefault((sub, ses), []).append(shard_dir)
+                merge_session(os.path.join(shard_dir, sub, ses), out_session, report)
+
+    report['sessions'] = len(sessions)
+    report['overlapping'] = {"{}/{}".format(sub, ses): dirs for (sub, ses), dirs in sorted(sessions.items()) if len(dirs) > 1}
+
+    if df is not None:
+        for idx, row in df.iterrows():
+            if not os.path.exists(os.path.join(out_bids, "sub-{bids_pid}".format(bids_pid=row['bids_pid']), "ses-{bids_age}".format(bids_age=row['bids_age']))):
+                report['missing'].append({'dir': row['dir'], 'bids_pid': row['bids_pid'], 'bids_age': row['bids_age']})
+
+    return report
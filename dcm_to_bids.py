@@ -1,143 +1,219 @@
-import pydicom 
-from pydicom import dcmread
-
-import glob
 import argparse
 import os
 import shutil
 import sys
-from pathlib import Path
-import pandas as pd
-import re
-import subprocess
 import json
+import asyncio
+import concurrent.futures
+import tempfile
+import time
+import traceback
+
+# pandas is only imported by the --csv batch mode and the dataset index, pydicom once a dicom has to be read and numpy
+# with the --native_convert converter, so the startup of the per subject runs only loads what they use
+from converter_runner import ConverterRunner
+from csv_rows import read_rows, write_rows
+from dataset_shards import DatasetIndex, merge_shards, parse_shard
+from dicom_archive import is_archive, split_dir_name
+from dicom_index import SPLIT_TAGS, scan_tags
+from dicom_split import bcolors, dicom_dir_split, link_series, report_duplicates, split_file_name
+from dicom_stream import SeriesStream
+from manifest import MANIFEST_NAME, ConversionManifest
+from output_plan import OutputPlan, intended_for
+from profiling import Metrics, metrics_requested, summarize
+from scan_matcher import shared_matcher
+from series import SeriesRecord, duplicate_report, load_manifest_records, session_date
+from sidecars import SidecarStore
+
+# Directory of the session with the output of the converters for each series
+CONVERTER_LOG_DIR = '.converter_logs'
+
+# Files of the session dropped because they repeat the SOPInstanceUID of another file, in CONVERTER_LOG_DIR
+DUPLICATE_REPORT_NAME = 'duplicates.json'
+
+# Scans whose sidecars are edited again at the end of the session (IntendedFor), they are written then
+DEFERRED_SIDECAR_SCANS = ['fmap']
+
+def write_duplicate_report(series_records, out_bids_sub_age):
+    """Write the files dropped as duplicates to the converter log directory of the session, if there are any"""
+
+    report = duplicate_report(series_records)
+    if len(report) == 0:
+        return None
+
+    log_dir = os.path.join(out_bids_sub_age, CONVERTER_LOG_DIR)
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+    out_report = os.path.join(log_dir, DUPLICATE_REPORT_NAME)
+    print(bcolors.INFO, "Writing:", out_report, bcolors.ENDC)
+    with open(out_report, 'w') as f:
+        json.dump({'series': report}, f, indent=4)
+
+    return out_report
+
+def find_all_converted(args, series_records, bids_info, matcher, sidecars, choices=['.nii.gz', '.nrrd']):
+    """Find all the converted series of the session, including the ones converted by previous runs.
+    The outputs recorded in the conversion manifest are already in the series records, only the sidecars
+    of the outputs that are not in the manifest are read"""
 
-class bcolors:
-    HEADER = '\033[95m'
-    OK = '\033[94m'
-    INFO = '\033[96m'
-    SUCCESS = '\033[92m'
-    WARNING = '\033[93m'
-    FAIL = '\033[91m'
-    ENDC = '\033[0m'
-    BOLD = '\033[1m'
-    UNDERLINE = '\033[4m'
+    series_converted = {}
 
-def dicom_dir_split(args):
+    out_bids_sub_age = os.path.join(args.out_bids, "sub-" + bids_info['bids_pid'], 'ses-' + bids_info['bids_age'])
 
-    files = glob.glob(os.path.join(args.dir, '**'), recursive = True)
+    known_outputs = set()
+    for sn_sd in sorted(series_records):
+        record = series_records[sn_sd]
+        known_outputs.update(record.outputs)
 
-    series_description = {}
-    series_files = {}
-    patient_id = ''
-    patient_age = ''
+        if record.converted is not None:
+            img = os.path.join(out_bids_sub_age, record.converted)
+            if(os.path.exists(img)):
+                series_converted[sn_sd] = record.converted
+            else:
+                print(bcolors.WARNING, "File not found when generating dictionary for tsv file", img, bcolors.ENDC)
 
+    for scan in matcher.scans:
 
-    for file in files:
-        try:
-            if Path(file).is_file():
-                ds = dcmread(file)
-                sn = ds['SeriesNumber'].value
-                sd = ds['SeriesDescription'].value
+        out_bids_scan_dir = os.path.join(out_bids_sub_age, scan)
 
-                sn_sd = (sn, sd)
+        if os.path.exists(out_bids_scan_dir):
 
-                if(patient_id == ''):
-                    patient_id = ds['PatientID'].value
+            for jsf in sorted(os.listdir(out_bids_scan_dir)):
 
-                if(patient_age == ''):
-                    patient_age = ds['PatientAge'].value
+                if not jsf.endswith('.json') or os.path.join(scan, jsf) in known_outputs:
+                    continue
 
-                if sn_sd not in series_description:
-                    series_description[sn_sd] = sd
-                    series_files[sn_sd] = []
+                sidecar_json = sidecars.get(os.path.join(out_bids_scan_dir, jsf))
 
-                series_files[sn_sd].append(file)
-        except:
-            print(bcolors.FAIL, "Not a dicom file:", file, bcolors.ENDC, file=sys.stderr)
+                record = SeriesRecord.from_sidecar(sidecar_json)
+                sn_sd = record.sn_sd
 
-    if args.skip_split:
-        return series_description, series_files, {'patient_id': patient_id, 'patient_age': patient_age}
+                img = os.path.join(scan, jsf.replace('.json', args.out_ext))
 
-    if args.out_dcm is None:
-        print(bcolors.FAIL, "Please set a valid output directory for the dicom split using --out_dcm flag", bcolors.ENDC, file=sys.stderr)
-    out_dcm = os.path.join(args.out_dcm, os.path.basename(args.dir))
+                if(os.path.exists(os.path.join(out_bids_sub_age, img))):
+                    series_converted[sn_sd] = img
+                    if sn_sd not in series_records:
+                        series_records[sn_sd] = record
+                    series_records[sn_sd].outputs += [os.path.join(scan, jsf), img]
+                else:
+                    print(bcolors.WARNING, "File not found when generating dictionary for tsv file", img, bcolors.ENDC)
 
-    print(bcolors.INFO, "Generating directories ...", bcolors.ENDC)
+    return series_converted
 
-    for sn_sd in series_description:
 
-        sn, sd = sn_sd
+def report_classification(classification):
+    # Series matching more than one rule are converted once per rule, series that do not match are not converted
+    for sn_sd in classification['ambiguous']:
+        print(bcolors.WARNING, "WARNING: series", sn_sd, "matches more than one pattern:", ", ".join(rule['out_name'] for rule in classification['matches'][sn_sd]), bcolors.ENDC, file=sys.stderr)
+    for sn_sd in classification['unmatched']:
+        print(bcolors.INFO, "Series", sn_sd, "does not match any pattern and will not be converted", bcolors.ENDC)
 
-        out_sd = str(sn) + "_" + sd
-        out_dir = os.path.join(out_dcm, out_sd)
+def classify_only(series_description, bids_info, matcher):
+    """Print the bids output name of each series without converting anything"""
 
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
+    classification = matcher.classify(series_description)
+    report_classification(classification)
 
+    plan = matcher.plan(classification)
 
-    print(bcolors.INFO, "linking dicoms ...", bcolors.ENDC)
-    for sn_sd in series_description:
+    print(bcolors.INFO, "Classification:", bcolors.ENDC)
+    for rule, sn_sd, run_number in sorted(plan, key=lambda p: p[1]):
+        bids_info_g = dict(bids_info)
+        bids_info_g['run_number'] = run_number
+        bids_info_g['ext'] = ''
+        print(sn_sd[0], sn_sd[1], '->', os.path.join(rule['scan'], rule['out_name'].format(**bids_info_g)))
 
-        sn, sd = sn_sd
+    return plan
 
-        sfs = series_files[sn_sd]
+def dry_run(args, series_description, series_files, series_records, bids_info, matcher):
+    """Print the output plan of the session: the files each series would be renamed to, the collisions and the files
+    that would be replaced, and the IntendedFor of the fieldmaps. Nothing is converted or written"""
 
-        for sf in sfs:
+    out_bids_sub_age = os.path.join(args.out_bids, "sub-" + bids_info['bids_pid'], 'ses-' + bids_info['bids_age'])
+    manifest = ConversionManifest(os.path.join(out_bids_sub_age, MANIFEST_NAME))
 
-            out_sd = str(sn) + "_" + sd
-            out_sf = os.path.join(out_dcm, out_sd, os.path.basename(sf))
+    classification = matcher.classify(series_description)
+    report_classification(classification)
 
-            if os.path.splitext(out_sf)[1] == '':
-                out_sf += ".dcm"
+    series_converted = {}
+    jobs = plan_jobs(args, classification, series_files, series_records, matcher, manifest, series_converted, None, out_bids_sub_age)
 
-            try:
-                
-                sf = Path(sf).absolute()
-                out_sf = Path(out_sf).absolute()
+    plan = OutputPlan(out_bids_sub_age, manifest, args.force_convert)
+    for job in jobs:
+        plan.add(job, expected_outputs(args, job), bids_info)
 
-                print(bcolors.SUCCESS, "link:", sf, '->', out_sf, bcolors.ENDC)
-                os.symlink(sf, out_sf)
+    collisions, overwrites = plan.check()
 
-            except:
-                print(bcolors.FAIL, "Error linking file", sf, bcolors.ENDC, file=sys.stderr)
+    print(bcolors.INFO, "Output plan:", len(jobs), "series to convert", bcolors.ENDC)
+    for line in plan.lines():
+        print(line)
+    report_output_plan(plan, collisions, overwrites)
 
-    print(bcolors.SUCCESS, "Dicom split done!", bcolors.ENDC)
-    return series_description, series_files, {'patient_id': patient_id, 'patient_age': patient_age}
+    fmap_json, nii_files = intended_for(plan.outputs(), bids_info['bids_age'])
+    for file in fmap_json:
+        print(file, "IntendedFor", nii_files)
 
-def find_all_converted(args, series_description, bids_info, df_search, choices=['.nii.gz', '.nrrd']):
+    return plan
 
-    groups = df_search.groupby('scan')
+def converter_runner(args, metrics=None):
+    return ConverterRunner(jobs=args.convert_jobs, timeout=args.convert_timeout if args.convert_timeout > 0 else None, retries=args.convert_retries, backoff=args.convert_backoff, metrics=metrics)
 
-    series_converted = {}
+async def run_converter(args, runner, job):
+    """Run dcm2niix (and DWIConvert for the dwi if requested) for one series. The outputs are written to the staging
+    directory of the job so series converted at the same time do not mix their files"""
 
-    for scan, df_g in groups:
+    async with runner.limit():
 
-        out_bids_sub_age = os.path.join(args.out_bids, "sub-" + bids_info['bids_pid'], 'ses-' + bids_info['bids_age']) + os.path.sep
-        out_bids_scan_dir = os.path.join(out_bids_sub_age, scan)
+        if native_convert(args, job) and await run_native_converter(args, runner, job):
+            return
 
-        if os.path.exists(out_bids_scan_dir):
-            json_files = glob.glob(os.path.join(out_bids_scan_dir, '*.json'))
+        # Without a split directory the files of the series are linked to a temporary directory that only lives during the conversion
+        if job['dicom_dir'] is None:
+            dicom_dir = tempfile.mkdtemp(prefix=job['out_sd'] + '_', dir=args.tmp_dir)
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, link_series, job['files'], dicom_dir, args.link_mode)
+                await runner.run(converter_commands(args, job, dicom_dir), job['log'], job['staging_dir'])
+            finally:
+                shutil.rmtree(dicom_dir, ignore_errors=True)
+        else:
+            await runner.run(converter_commands(args, job, job['dicom_dir']), job['log'], job['staging_dir'])
 
-            for jsf in glob.glob(os.path.join(out_bids_scan_dir, '*.json')):
-                sidecar_json = json.load(open(jsf))
+def native_convert(args, job):
+    # Scans converted in process (--native_convert), the dwi go to DWIConvert if it is requested
+    if args.native_convert is None or job['scan'] not in args.native_convert:
+        return False
+    return not (args.use_dwi_convert and job['scan'] == "dwi")
 
-                sn = sidecar_json["SeriesNumber"]
-                sd = sidecar_json["SeriesDescription"]
+async def run_native_converter(args, runner, job):
+    """Convert the series in process with pydicom and numpy, without starting dcm2niix or linking the files.
+    Returns False if the series cannot be converted this way (multi frame, several volumes etc.), it is then
+    converted with dcm2niix"""
 
-                sn_sd = (sn, sd)
+    start = time.perf_counter()
 
-                img = jsf.replace('.json', args.out_ext)
+    try:
+        # numpy is only imported once a series is converted in process
+        from dicom_convert import convert_series
+        outputs = await asyncio.get_event_loop().run_in_executor(None, convert_series, job['files'], job['staging_dir'], job['out_sd'], args.out_ext)
+    except Exception as e:
+        print(bcolors.WARNING, "In process conversion of", job['out_sd'], "not possible, using dcm2niix:", e, bcolors.ENDC)
+        for f in os.listdir(job['staging_dir']):
+            os.remove(os.path.join(job['staging_dir'], f))
+        if runner.metrics is not None:
+            runner.metrics.count(runner.stage, 'native_fallbacks')
+        return False
 
-                if(os.path.exists(img)):
-                    series_converted[sn_sd] = img.replace(out_bids_sub_age, '')
-                else:
-                    print(bcolors.WARNING, "File not found when generating dictionary for tsv file", img, bcolors.ENDC)
+    seconds = time.perf_counter() - start
+    with open(job['log'], 'w') as log:
+        log.write("In process conversion of {n} files -> {outputs} [{seconds:.1f} s]\n".format(n=len(job['files']), outputs=", ".join(outputs), seconds=seconds))
 
-    return series_converted
+    print(bcolors.SUCCESS, "Converted in process:", job['out_sd'], "({n} files, {seconds:.2f} s)".format(n=len(job['files']), seconds=seconds), bcolors.ENDC)
+    if runner.metrics is not None:
+        runner.metrics.count(runner.stage, 'native_converted')
 
+    return True
 
-def convert(args, series_description, bids_info, df_search, choices=['.nii.gz', '.nrrd']):
+def converter_commands(args, job, dicom_dir):
 
     dcm2niix_e = "n" #.nii.gz by default
     dwiconvert_conversion_mode = "DicomToFSL"
@@ -145,224 +221,889 @@ def convert(args, series_description, bids_info, df_search, choices=['.nii.gz',
         dcm2niix_e = "y"
         dwiconvert_conversion_mode = "DicomToNrrd"
 
-    if args.out_dcm is not None:
-        out_dcm = os.path.join(args.out_dcm, os.path.basename(args.dir))
-    else:
-        out_dcm = args.dir
-
-    # Of all the entries in the pattern_search_scans.csv file we group them by scan as these will all go to the same directory and we need to keep track of the runs. These can be for example T1/T2 going to anat folder or different types of DWI 6shell 76dir etc.
-    groups = df_search.groupby('scan')
-
-    series_converted = {}
-
-    for scan, df_g in groups:
-
-        for idx, g in df_g.iterrows():
+    staging_dir = job['staging_dir']
 
-            out_bids_scan_dir = os.path.join(args.out_bids, "sub-" + bids_info['bids_pid'], 'ses-' + bids_info['bids_age'], scan)
+    if args.use_dwi_convert and job['scan'] == "dwi":
 
-            # We start the counter for each run and iterate through the sorted series description by series number
-            run_number = 1
-            for sn_sd in sorted(series_description):
+        out_dwi_convert = os.path.join(staging_dir, job['out_sd'] + args.out_ext)
 
-                sd = series_description[sn_sd]
-                
-                # if the series description matches the regex pattern we process this file using dcm2niix to create the output nii file and json side car
-                if re.match(g['match'], sd, re.IGNORECASE):
-
-                    if not os.path.exists(out_bids_scan_dir):
-                        os.makedirs(out_bids_scan_dir)
-
-                    sn = sn_sd[0]
-                    out_sd = str(sn) + "_" + sd
-                    dicom_dir = os.path.join(out_dcm, out_sd)
-
-                    if args.use_dwi_convert and scan == "dwi":
-
-                        out_dwi_convert = os.path.join(out_bids_scan_dir, out_sd + args.out_ext)
-
-                        subprocess.run([args.dwi_convert, "--conversionMode", dwiconvert_conversion_mode, "-i", dicom_dir, "--useBMatrixGradientDirections", "-o", out_dwi_convert], stdout=sys.stdout, stderr=sys.stderr)
+        return [[args.dwi_convert, "--conversionMode", dwiconvert_conversion_mode, "-i", dicom_dir, "--useBMatrixGradientDirections", "-o", out_dwi_convert],
+            [args.dcm2niix, "-b", "o", "-o", staging_dir, dicom_dir]]
+    else:
+        return [[args.dcm2niix, "-e", dcm2niix_e,"-b", "y", "-o", staging_dir, dicom_dir]]
 
-                        subprocess.run(["dcm2niix", "-b", "o", "-o", out_bids_scan_dir, dicom_dir], stdout=sys.stdout, stderr=sys.stderr)
-                    else:
-                        subprocess.run(["dcm2niix", "-e", dcm2niix_e,"-b", "y", "-o", out_bids_scan_dir, dicom_dir], stdout=sys.stdout, stderr=sys.stderr)
+def expected_outputs(args, job):
+    # Files the converters are expected to write for the job, used by --dry_run instead of listing the staging directory
+    names = [job['out_sd'] + args.out_ext, job['out_sd'] + ".json"]
+    if job['scan'] == "dwi" and args.out_ext != ".nrrd":
+        names += [job['out_sd'] + ".bval", job['out_sd'] + ".bvec"]
+    return names
 
-                    # We find ALL the output files based on the output series description and series number
-                    # it includes .json .nii.gz .bvals .bvecs etc.
-                    files = glob.glob(os.path.join(out_bids_scan_dir, '*{out_sd}*'.format(out_sd=out_sd)))
+def raw_input_dir(args):
+    # The converters read the input directory itself, the split directories of --out_dcm only have the files kept
+    return args.skip_split and args.out_dcm is None
 
-                    check_renames = {}
+def series_fingerprint(args, files):
+    # The series of an archive that are not extracted (--dry_run before the split) are only archive members, they have
+    # no fingerprint and are planned as series to convert
+    if is_archive(args.dir) and not all(os.path.exists(f) for f in files):
+        return None
+    return ConversionManifest.fingerprint(files)
 
-                    for file in files:
+def plan_jobs(args, classification, series_files, series_records, matcher, manifest, series_converted, out_dcm, out_bids_sub_age, metrics=None):
+    """Conversion jobs of the classified series, in the order of matcher.plan. Series converted by a previous run with the
+    same dicom files and run number are skipped, their main output goes to series_converted"""
 
-                        ext = os.path.splitext(file)[1]
-                        if ext == ".gz":
-                            ext = ".nii.gz"
+    jobs = []
 
-                        bids_info_g = bids_info.copy()
+    for rule, sn_sd, run_number in matcher.plan(classification):
 
-                        bids_info_g['run_number'] = run_number                      
-                        bids_info_g['ext'] = ext
+        sn, sd = sn_sd
+        out_sd = str(sn) + "_" + sd
 
-                        rename_file = g['out_name'].format(**bids_info_g)
+        series_uid = series_records[sn_sd].series_uid or out_sd
+        key = ConversionManifest.key(series_uid, rule)
+        fingerprint = series_fingerprint(args, series_files[sn_sd])
+        if fingerprint is not None:
+            manifest.inputs.add(fingerprint)
 
-                        if sn_sd not in series_converted and ext in choices:
-                            series_converted[sn_sd] = os.path.join(scan, rename_file)
+        # Series converted by a previous run with the same dicom files are not converted again
+        entry = None
+        if not args.force_convert:
+            entry = manifest.lookup(key, fingerprint, run_number)
+        if entry is not None:
+            print(bcolors.INFO, "Up to date, skipping:", out_sd, "->", ", ".join(entry['outputs']), bcolors.ENDC)
+            if metrics is not None:
+                metrics.count('convert', 'series_up_to_date')
+            if sn_sd not in series_converted and entry['converted'] is not None:
+                series_converted[sn_sd] = entry['converted']
+            continue
 
-                        if ext in check_renames:
-                            rename_file += "_{num}".format(num=check_renames[ext])
-                            print(bcolors.WARNING, "WARNING: It appears the conversion went wrong as there are more than 1 file with the same extension", bcolors.ENDC, file=sys.stderr)
+        jobs.append(conversion_job(rule, sn_sd, series_files[sn_sd], key, fingerprint, out_dcm, out_bids_sub_age, run_number))
 
-                        # We proceed to rename the files based on the patterns
+        # The input given with --skip_split also has the duplicate files, only the files kept are linked for the converter
+        if raw_input_dir(args) and len(series_records[sn_sd].duplicates) > 0:
+            jobs[-1]['dicom_dir'] = None
 
-                        rename_file = os.path.join(out_bids_scan_dir, rename_file)
-                        try:
-                            print(bcolors.SUCCESS, "Renaming:", file, "->", rename_file, bcolors.ENDC)
-                            os.rename(file, rename_file)
-                        except:
-                            print(bcolors.FAIL, "Error renaming file!", bcolors.ENDC, file=sys.stderr)
+    return jobs
 
+def open_session(args, bids_info, matcher):
+    """Create the session directory of the bids output and load its manifest, which keeps track of the series converted
+    in previous runs. The staging directories left by a stopped run are removed"""
 
+    out_bids_sub_age = os.path.join(args.out_bids, "sub-" + bids_info['bids_pid'], 'ses-' + bids_info['bids_age'])
+    if not os.path.exists(out_bids_sub_age):
+        os.makedirs(out_bids_sub_age)
+    manifest = ConversionManifest(os.path.join(out_bids_sub_age, MANIFEST_NAME))
+    remove_staging_dirs(out_bids_sub_age, matcher.scans)
 
-                        if not pd.isna(g["add_json"]) and ext == ".json":
-                            add_json = json.loads(g["add_json"])
-                            sidecar_json = json.load(open(rename_file))
-                            sidecar_json.update(add_json)
-                            json.dump(sidecar_json, open(rename_file, 'w'), indent=4, sort_keys=True)
+    return out_bids_sub_age, manifest
 
-                        if ext not in check_renames:
-                            check_renames[ext] = 0
+def convert(args, series_description, series_files, series_records, bids_info, matcher, sidecars, choices=['.nii.gz', '.nrrd'], metrics=None):
 
-                        check_renames[ext] += 1
+    if args.out_dcm is not None:
+        out_dcm = os.path.join(args.out_dcm, split_dir_name(args.dir))
+    elif args.skip_split:
+        out_dcm = args.dir
+    else:
+        # The series are linked to temporary directories by run_converter
+        out_dcm = None
 
-                    run_number+=1   
+    out_bids_sub_age, manifest = open_session(args, bids_info, matcher)
 
-    return series_converted
+    # The rules of the pattern_search_scans.csv file are grouped by scan as these will all go to the same directory and we need to keep track of the runs. These can be for example T1/T2 going to anat folder or different types of DWI 6shell 76dir etc.
+    # All the series are classified in a single pass and the run numbers are assigned here, in series number order,
+    # so they do not depend on the order in which the conversions finish
+    classification = matcher.classify(series_description)
+    report_classification(classification)
 
-def generate_tsv(args, series_files, series_converted, bids_info):
+    series_converted = {}
+    jobs = plan_jobs(args, classification, series_files, series_records, matcher, manifest, series_converted, out_dcm, out_bids_sub_age, metrics)
+
+    # Each conversion writes to its own staging directory inside the scan directory, then the external converters run
+    # concurrently as they do not depend on each other
+    for job in jobs:
+        make_staging_dir(job)
+
+    print(bcolors.INFO, "Converting", len(jobs), "series using", args.convert_jobs, "workers ...", bcolors.ENDC)
+    failed = asyncio.run(convert_jobs(args, jobs, bids_info, series_converted, manifest, sidecars, choices, metrics))
+
+    return series_converted, failed
+
+async def convert_jobs(args, jobs, bids_info, series_converted, manifest, sidecars, choices=['.nii.gz', '.nrrd'], metrics=None):
+    # Returns the jobs that failed
+    runner = converter_runner(args, metrics)
+    pending = [(job, asyncio.ensure_future(run_converter(args, runner, job))) for job in jobs]
+    return await finish_jobs(args, pending, bids_info, series_converted, manifest, sidecars, choices, metrics)
+
+async def finish_jobs(args, pending, bids_info, series_converted, manifest, sidecars, choices=['.nii.gz', '.nrrd'], metrics=None):
+    """Rename the outputs of the (job, future) pairs in order, each series as soon as it and the ones before it are
+    converted. The files every series is expected to write are reserved first so a collision with a series converted
+    later is found before anything is renamed. Returns the jobs that failed"""
+
+    plan = OutputPlan(os.path.dirname(manifest.filename), manifest, args.force_convert)
+    for job, future in pending:
+        plan.reserve(job, expected_outputs(args, job), bids_info)
+
+    failed = []
+
+    # The staging directory of each series is listed once, when it is converted
+    for job, future in pending:
+        await asyncio.wait([future])
+        if not check_conversion(job, future, metrics):
+            failed.append(job)
+            continue
+        j = plan.add(job, os.listdir(job['staging_dir']), bids_info)
+        if not rename_outputs(plan, j, series_converted, manifest, sidecars, choices, metrics):
+            failed.append(job)
+
+    return failed
+
+def conversion_job(rule, sn_sd, files, key, fingerprint, out_dcm, out_bids_sub_age, run_number=None):
+    # Everything run_converter and the output plan need to convert one series with one rule
+    sn, sd = sn_sd
+    out_sd = str(sn) + "_" + sd
+
+    return {
+        'scan': rule['scan'],
+        'rule': rule,
+        'sn_sd': sn_sd,
+        'out_sd': out_sd,
+        'key': key,
+        'fingerprint': fingerprint,
+        'dicom_dir': os.path.join(out_dcm, out_sd) if out_dcm is not None else None,
+        'files': files,
+        'out_bids_sub_age': out_bids_sub_age,
+        'out_bids_scan_dir': os.path.join(out_bids_sub_age, rule['scan']),
+        'run_number': run_number
+        }
+
+def make_staging_dir(job):
+    if not os.path.exists(job['out_bids_scan_dir']):
+        os.makedirs(job['out_bids_scan_dir'])
+    job['staging_dir'] = tempfile.mkdtemp(prefix='.' + job['out_sd'] + '_', dir=job['out_bids_scan_dir'])
+
+    # The output of the converters for the series is kept in the session directory
+    log_dir = os.path.join(job['out_bids_sub_age'], CONVERTER_LOG_DIR)
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+    job['log'] = os.path.join(log_dir, "{out_sd}_{scan}_{index}.log".format(out_sd=job['out_sd'], scan=job['scan'], index=job['rule']['index']))
+
+def check_conversion(job, future, metrics=None):
+    """Returns True if the conversion of the job succeeded. If it failed the outputs are discarded, so only this series
+    is missing"""
+
+    try:
+        future.result()
+    except Exception as e:
+        print(bcolors.FAIL, "Error converting", job['out_sd'], e, bcolors.ENDC, file=sys.stderr)
+        shutil.rmtree(job['staging_dir'], ignore_errors=True)
+        if metrics is not None:
+            metrics.count('convert', 'series_failed')
+        return False
+
+    return True
+
+def remove_staging_dirs(out_bids_sub_age, scans):
+    # Staging directories left in the scan directories by a run that was stopped, they are hidden and named after the series
+    for scan in scans:
+        out_bids_scan_dir = os.path.join(out_bids_sub_age, scan)
+        if not os.path.isdir(out_bids_scan_dir):
+            continue
+        for name in os.listdir(out_bids_scan_dir):
+            path = os.path.join(out_bids_scan_dir, name)
+            if name.startswith('.') and os.path.isdir(path):
+                print(bcolors.INFO, "Removing staging directory of a previous run:", path, bcolors.ENDC)
+                shutil.rmtree(path, ignore_errors=True)
+
+def report_output_plan(plan, collisions, overwrites, jobs=None):
+    for collision in collisions:
+        print(bcolors.FAIL, "Output collision:", collision['target'], collision['reason'] + ":", ", ".join(collision['series']), bcolors.ENDC, file=sys.stderr)
+    for overwrite in overwrites:
+        print(bcolors.WARNING, "Replacing a file", overwrite['reason'] + ":", overwrite['target'], bcolors.ENDC)
+    for r in plan.renames:
+        if r['repeated'] and (jobs is None or r['job'] in jobs):
+            print(bcolors.WARNING, "WARNING: It appears the conversion went wrong as there are more than 1 file with the same extension", r['source'], bcolors.ENDC, file=sys.stderr)
+
+def rename_outputs(plan, j, series_converted, manifest, sidecars, choices=['.nii.gz', '.nrrd'], metrics=None):
+    """Check the renames of job j of the output plan and rename its files. A series with a collision is not renamed and
+    False is returned. The renamed series gets the extra json fields of its pattern and is recorded in the manifest, which
+    is saved after each series so an interrupted run can be resumed"""
+
+    job = plan.jobs[j]
+
+    collisions, overwrites = plan.check([j])
+    report_output_plan(plan, collisions, overwrites, [j])
+
+    if j in plan.failed:
+        shutil.rmtree(job['staging_dir'], ignore_errors=True)
+        if metrics is not None:
+            metrics.count('convert', 'series_failed')
+        return False
+
+    for k, r in plan.planned([j]):
+        print(bcolors.SUCCESS, "Renaming:", r['source'], "->", r['target'], bcolors.ENDC)
+
+    renamed, errors = plan.apply([j])
+    for r, e in errors:
+        print(bcolors.FAIL, "Error renaming file!", r['source'], e, bcolors.ENDC, file=sys.stderr)
+
+    sn_sd = job['sn_sd']
+    rule = job['rule']
+
+    for k, r in plan.planned([j]):
+        if r['target'] not in renamed[j]:
+            continue
+        if sn_sd not in series_converted and r['ext'] in choices:
+            series_converted[sn_sd] = os.path.join(job['scan'], os.path.basename(r['target']))
+        if rule["add_json"] is not None and r['ext'] == ".json":
+            sidecars.update(r['target'], rule["add_json"])
+
+    # The sidecars of the fieldmaps get the IntendedFor field at the end of the session, they are written once then
+    if job['scan'] not in DEFERRED_SIDECAR_SCANS:
+        sidecars.flush(renamed[j])
+
+    if metrics is not None:
+        metrics.count('convert', 'series_converted')
+        metrics.count('convert', 'files_renamed', len(renamed[j]))
+
+    if len(renamed[j]) > 0:
+        manifest.record(job['key'], {
+            'series_number': sn_sd[0],
+            'series_description': sn_sd[1],
+            'fingerprint': job['fingerprint'],
+            'run_number': job['run_number'],
+            'outputs': [os.path.relpath(f, job['out_bids_sub_age']) for f in renamed[j]],
+            'converted': series_converted.get(sn_sd)
+            })
+        manifest.save()
+
+    shutil.rmtree(job['staging_dir'], ignore_errors=True)
+
+    return True
+
+def generate_tsv(args, series_records, series_converted, bids_info, metrics=None):
     print("Generating TSV ...")
 
     scans_df = []
 
+    # The acquisition date and time come from the series records, no need to open the dicoms again
+    # Series from previous runs only have the time written by dcm2niix in the sidecar, the date of the session is used for them
+    default_date = session_date(series_records)
+
     for sn_sd in sorted(series_converted):
 
-        sf_dcm = dcmread(series_files[sn_sd][0])
         sf_converted = series_converted[sn_sd]
-
-        acquisition_date = sf_dcm['AcquisitionDate']    
-        acquisition_time = sf_dcm['AcquisitionTime']
-        
-        acquisition_date = '-'.join([acquisition_date[0:4], acquisition_date[4:6], acquisition_date[6:]])
-        acquisition_time = ':'.join([acquisition_time[0:2], acquisition_time[2:4], acquisition_time[4:6]])
-
-        acq_time = "{acquisition_date}T{acquisition_time}".format(**{'acquisition_date': acquisition_date, 'acquisition_time': acquisition_time})
+        acq_time = series_records[sn_sd].acq_time(default_date)
 
         scans_df.append({'filename': sf_converted, 'acq_time': acq_time})
 
 
     out_bids_scans_acq_time = os.path.join(args.out_bids, "sub-" + bids_info['bids_pid'], 'ses-' + bids_info['bids_age'], "sub-" + bids_info['bids_pid'] + "_" + "ses-" + bids_info['bids_age'] + "_scans.tsv")
 
-    scans_df = pd.DataFrame(scans_df)
-
     print(bcolors.INFO, "Writing:", out_bids_scans_acq_time, bcolors.ENDC)
-    scans_df.to_csv(out_bids_scans_acq_time, index=False, sep='\t')
+    write_rows(out_bids_scans_acq_time, scans_df, ['filename', 'acq_time'], delimiter='\t')
+
+    if metrics is not None:
+        metrics.count('generate_tsv', 'rows', len(scans_df))
 
-def insert_intended_for_fmap(bids_dir, bids_info):
-    """Insert the IntendedFor field to JSON sidecart for fieldmap data"""
+def insert_intended_for_fmap(bids_dir, bids_info, sidecars, metrics=None, series_records=None):
+    """Insert the IntendedFor field to JSON sidecart for fieldmap data
+    The files of the fmap, func and dwi directories are taken together with the outputs of the series records (recorded
+    in the manifest), only the ones that exist are kept"""
 
     obj = bids_info.copy()
     obj['bids_dir'] = bids_dir
 
-    fmap_path = "{bids_dir}/sub-{bids_pid}/ses-{bids_age}/fmap".format(**obj)
-    func_path = "{bids_dir}/sub-{bids_pid}/ses-{bids_age}/func".format(**obj)
-    dwi_path = "{bids_dir}/sub-{bids_pid}/ses-{bids_age}/dwi".format(**obj)
+    sub_age = "{bids_dir}/sub-{bids_pid}/ses-{bids_age}".format(**obj)
 
-    nii_files = []
-    json_files = []
+    outputs = set()
+    for scan in ["fmap", "func", "dwi"]:
+        if os.path.exists(os.path.join(sub_age, scan)):
+            outputs.update(os.path.join(scan, file) for file in os.listdir(os.path.join(sub_age, scan)))
 
-    if os.path.exists(fmap_path):
-        fmap_files = [os.path.join(fmap_path, f) for f in os.listdir(fmap_path)]
-        json_files = [f for f in fmap_files if f.endswith(".json")]
-        print(f"List of JSON files to amend {json_files}")
+    if series_records is not None:
+        outputs.update(output for record in series_records.values() for output in record.outputs)
 
-    if os.path.exists(func_path):               
-
-        # makes list of the func files to add into the intended for field
-        func_files = ["ses-{bids_age}/func/{file}".format(bids_age=obj['bids_age'], file=file) for file in os.listdir(func_path)]
-        nii_files += [i for i in func_files if i.endswith(".nii.gz") and "sbref" not in i]                
-
-    if os.path.exists(dwi_path):
-
-        # makes list of the func files to add into the intended for field
-        dwi_files = ["ses-{bids_age}/dwi/{file}".format(bids_age=obj['bids_age'], file=file) for file in os.listdir(dwi_path)]
-        nii_files += [i for i in dwi_files if i.endswith(".nii.gz")]
+    fmap_json, nii_files = intended_for([f for f in outputs if os.path.exists(os.path.join(sub_age, f))], obj['bids_age'])
+    json_files = [os.path.join(sub_age, f) for f in fmap_json]
+    print(f"List of JSON files to amend {json_files}")
 
     if len(nii_files) > 0 and len(json_files) > 0:
 
         print("List of NII files", nii_files)
 
-        # Open the json files ('r' for read only) as a dictionary
-        # Adds the Intended for key
-        # Add the func files to the key value
-        # The f.close is a duplication.
-        # f can only be used inside the with "loop"
-        # we open the file again to write only and
-        # dump the dictionary to the files
+        # The field is added to the sidecars in memory, they are written with the other edits at the end of the session
         for file in json_files:
-            os.chmod(file, 0o664)
             print(f"Processing file {file}")
-            with open(file, "r") as f:
-                data = json.load(f)
-                data["IntendedFor"] = nii_files
-                f.close
-            with open(file, "w") as f:
-                json.dump(data, f, indent=4, sort_keys=True)
-                f.close
-                print("Done with re-write")
-
-def main(args, choices=['.nii.gz', '.nrrd']):
-
-    # series_description = { series_number_1: 'series_description_1', series_number_2: 'series_description_2'} etc.
-    args.dir = os.path.normpath(args.dir)
-    series_description, series_files, patient_obj = dicom_dir_split(args)
-
+            sidecars.update(file, {"IntendedFor": nii_files}, mode=0o664)
+            if metrics is not None:
+                metrics.count('insert_intended_for_fmap', 'json_updated')
+
+def metrics_filename(args, bids_pid, bids_age):
+    return os.path.join(args.metrics_out, "sub-{bids_pid}_ses-{bids_age}_metrics.json".format(bids_pid=bids_pid, bids_age=bids_age))
+
+def write_metrics(args, metrics, bids_info):
+    # --profile prints the time spent in each stage, --metrics_out saves the metrics of the subject as json
+    if args.profile:
+        print(bcolors.INFO, "Profile:", metrics.subject, bcolors.ENDC)
+        print(metrics.table())
+
+    if args.metrics_out is not None:
+        if not os.path.exists(args.metrics_out):
+            os.makedirs(args.metrics_out, exist_ok=True)
+        out_metrics = metrics_filename(args, bids_info['bids_pid'], bids_info['bids_age'])
+        print(bcolors.INFO, "Writing:", out_metrics, bcolors.ENDC)
+        metrics.save(out_metrics)
+
+def get_bids_info(args, patient_obj):
+    # bids id and age of the session from --bids_pid/--bids_age, the --csv_id file or the dicom PatientID and PatientAge
     if args.csv_id is not None:
-        df = pd.read_csv(args.csv_id)
+        rows = read_rows(args.csv_id)
 
-        if 'age' in df.columns() and not args.use_dirname_as_id:
-            query = 'pid == {patient_id} and age == {patient_age}'.format(**patient_obj)
+        if len(rows) > 0 and 'age' in rows[0] and not args.use_dirname_as_id:
+            query = {'pid': patient_obj['patient_id'], 'age': patient_obj['patient_age']}
         else:
             if args.use_dirname_as_id:
                 patient_obj = {
-                    'patient_id': os.path.basename(args.dir)
+                    'patient_id': split_dir_name(args.dir)
                 }
-            query = 'pid == {patient_id}'.format(**patient_obj)
+            query = {'pid': patient_obj['patient_id']}
 
-        rows = pd.query(query)
+        # The values of the csv are compared as strings, so ids with leading zeros are kept
+        rows = [row for row in rows if all(row[column] == str(value) for column, value in query.items())]
+
+        if len(rows) == 0:
+            print(bcolors.FAIL, "No entry found in csv_id file for", query, bcolors.ENDC, file=sys.stderr)
+            raise ValueError("{csv_id} has no entry for {query}".format(csv_id=args.csv_id, query=query))
 
         if(len(rows) > 1):
             print("WARNING! More than one entry found in csv_id file using query", query)
 
-        bids_info = rows.reset_index().loc[0]
+        bids_info = rows[0]
     else:
         bids_info = {'bids_pid': patient_obj['patient_id'], 'bids_age': patient_obj['patient_age']}
 
     if args.bids_pid and args.bids_age:
         bids_info = {'bids_pid': args.bids_pid, 'bids_age': args.bids_age}
 
+    return bids_info
+
+def stream_submit(args, runner, matcher, manifest, jobs, sn_sd, files, record, out_dcm, out_bids_sub_age, metrics=None):
+    """Start the conversion of a finished series with every rule it matches. Series up to date in the manifest are not
+    converted, their run number is checked once all the series are known. jobs[(sn_sd, rule index)] gets (job, future, entry)"""
+
+    sn, sd = sn_sd
+    out_sd = str(sn) + "_" + sd
+    fingerprint = ConversionManifest.fingerprint(files)
+    manifest.inputs.add(fingerprint)
+
+    for rule in matcher.match(sd):
+
+        key = ConversionManifest.key(record.series_uid or out_sd, rule)
+        job = conversion_job(rule, sn_sd, files, key, fingerprint, out_dcm, out_bids_sub_age)
+        if raw_input_dir(args) and len(record.duplicates) > 0:
+            job['dicom_dir'] = None
+
+        entry = None
+        if not args.force_convert:
+            entry = manifest.lookup(key, fingerprint, None)
+        if entry is not None:
+            jobs[(sn_sd, rule['index'])] = (job, None, entry)
+            continue
+
+        make_staging_dir(job)
+        future = asyncio.ensure_future(run_converter(args, runner, job))
+        # The file list is only needed by the converter
+        future.add_done_callback(lambda f, job=job: job.pop('files', None))
+        jobs[(sn_sd, rule['index'])] = (job, future, None)
+
+def stream_convert(args, matcher, sidecars, choices=['.nii.gz', '.nrrd'], metrics=None):
+    """Split and convert in a single pass for very large sessions (--stream 1). The tree is walked lazily and each series
+    is linked to --out_dcm and handed to the converters as soon as it is finished, while the scan goes on. Only the files of
+    the series being read or converted are kept in memory.
+    The run numbers depend on all the series of the session, so the outputs are renamed once the scan is done in the same
+    order as convert. Returns series_records, series_converted, bids_info and the jobs that failed"""
+
+    return asyncio.run(stream_convert_series(args, matcher, sidecars, choices, metrics))
+
+async def stream_convert_series(args, matcher, sidecars, choices=['.nii.gz', '.nrrd'], metrics=None):
+
+    if args.index_dir is not None:
+        print(bcolors.WARNING, "--index_dir is not used with --stream", bcolors.ENDC)
+
+    stream = SeriesStream(args.dir, scan_tags(args.scan_tags), header_only=args.header_only, jobs=args.jobs, backend=args.jobs_backend, sizes=metrics is not None and metrics_requested(args))
+
+    if args.out_dcm is not None:
+        out_dcm = os.path.join(args.out_dcm, split_dir_name(args.dir))
+    elif args.skip_split:
+        out_dcm = args.dir
+    else:
+        out_dcm = None
+    link = args.out_dcm is not None and not args.skip_split
+
+    series_description = {}
+    series_records = {}
+    series_converted = {}
+    jobs = {}
+    failed = []
+    bids_info = None
+    manifest = None
+
+    print(bcolors.INFO, "Streaming:", args.dir, bcolors.ENDC)
+
+    runner = converter_runner(args, metrics)
+    loop = asyncio.get_event_loop()
+
+    # The tree is read in a thread so the converters started by the loop keep running during the scan
+    series = iter(stream)
+
+    while True:
+
+        item = await loop.run_in_executor(None, next, series, None)
+        if item is None:
+            break
+        sn_sd, files, header = item
+
+        sn, sd = sn_sd
+        out_sd = str(sn) + "_" + sd
+
+        series_description[sn_sd] = sd
+        series_records[sn_sd] = SeriesRecord.from_header(header, len(files))
+        series_records[sn_sd].duplicates = stream.duplicates.pop(sn_sd, [])
+
+        if link:
+            out_dir = os.path.join(out_dcm, out_sd)
+            if not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+            linked = link_series(files, out_dir, args.link_mode)
+            if metrics is not None:
+                metrics.count('stream', 'links', linked)
+            print(bcolors.SUCCESS, "link:", linked, "files ->", out_dir, bcolors.ENDC)
+
+        if args.skip_convert:
+            continue
+
+        # The session is known once the first series is read
+        if bids_info is None:
+            bids_info = get_bids_info(args, stream.patient())
+            out_bids_sub_age, manifest = open_session(args, bids_info, matcher)
+
+        stream_submit(args, runner, matcher, manifest, jobs, sn_sd, files, series_records[sn_sd], out_dcm, out_bids_sub_age, metrics)
+
+    if metrics is not None:
+        metrics.count('stream', 'files', stream.files)
+        metrics.count('stream', 'dicoms', stream.dicoms)
+        if stream.sizes:
+            metrics.count('stream', 'input_bytes', stream.input_bytes)
+        metrics.count('stream', 'series', len(series_records))
+        metrics.count('stream', 'directories', len(stream.paths.dirs))
+
+    if bids_info is None:
+        bids_info = get_bids_info(args, stream.patient())
+
+    # Without any dicom the session is only created, as convert does
+    if manifest is None and not args.skip_convert:
+        out_bids_sub_age, manifest = open_session(args, bids_info, matcher)
+
+    # Series with files found after they were linked and handed to the converters are read again, the new files are
+    # linked and the series is converted with all its files
+    # If the files found later are only copies of the ones converted (a series sent twice) the conversion is kept
+    for sn_sd in sorted(stream.late):
+        sn, sd = sn_sd
+        out_sd = str(sn) + "_" + sd
+
+        files, header = stream.collect(sn_sd)
+        series_records[sn_sd] = SeriesRecord.from_header(header, len(files))
+        series_records[sn_sd].duplicates = stream.duplicates.pop(sn_sd, [])
+
+        if link:
+            linked = link_series([f for f in files if not os.path.lexists(split_file_name(out_dcm, out_sd, f))], os.path.join(out_dcm, out_sd), args.link_mode)
+            if metrics is not None:
+                metrics.count('stream', 'links', linked)
+            print(bcolors.SUCCESS, "link:", linked, "more files ->", os.path.join(out_dcm, out_sd), bcolors.ENDC)
+
+        # Series that match no pattern have no job
+        series_jobs = [key for key in jobs if key[0] == sn_sd]
+        if args.skip_convert or len(series_jobs) == 0:
+            continue
+
+        fingerprint = ConversionManifest.fingerprint(files)
+        if all(jobs[key][0]['fingerprint'] == fingerprint for key in series_jobs):
+            print(bcolors.INFO, "More files found for", out_sd, "after it was converted, all of them duplicates", bcolors.ENDC)
+            continue
+
+        print(bcolors.WARNING, "More files found for", out_sd, "after it was converted, converting it again", bcolors.ENDC)
+
+        for key in series_jobs:
+            job, future, entry = jobs.pop(key)
+            if future is not None:
+                await asyncio.wait([future])
+                shutil.rmtree(job['staging_dir'], ignore_errors=True)
+
+        stream_submit(args, runner, matcher, manifest, jobs, sn_sd, files, series_records[sn_sd], out_dcm, out_bids_sub_age, metrics)
+
+    if args.skip_convert:
+        return series_records, series_converted, bids_info, failed
+
+    report_duplicates(series_records, metrics, 'stream')
+
+    classification = matcher.classify(series_description)
+    report_classification(classification)
+
+    # The outputs are renamed in the same order as convert, once the run numbers are known
+    pending = []
+
+    for rule, sn_sd, run_number in matcher.plan(classification):
+
+        job, future, entry = jobs[(sn_sd, rule['index'])]
+
+        if entry is not None and entry['run_number'] == run_number:
+            print(bcolors.INFO, "Up to date, skipping:", job['out_sd'], "->", ", ".join(entry['outputs']), bcolors.ENDC)
+            if metrics is not None:
+                metrics.count('convert', 'series_up_to_date')
+            if sn_sd not in series_converted and entry['converted'] is not None:
+                series_converted[sn_sd] = entry['converted']
+            continue
+
+        if entry is not None:
+            # Converted by a previous run with another run number, the files of the series are read again to convert it
+            files, header = stream.collect(sn_sd)
+            make_staging_dir(job)
+            job['files'] = files
+            future = asyncio.ensure_future(run_converter(args, runner, job))
+
+        job['run_number'] = run_number
+        pending.append((job, future))
+
+    failed += await finish_jobs(args, pending, bids_info, series_converted, manifest, sidecars, choices, metrics)
+
+    return series_records, series_converted, bids_info, failed
+
+def main(args, choices=['.nii.gz', '.nrrd']):
+
+    # series_description = { series_number_1: 'series_description_1', series_number_2: 'series_description_2'} etc.
+    args.dir = os.path.normpath(args.dir)
+    if not os.path.exists(args.dir):
+        print(bcolors.FAIL, "Input not found:", args.dir, bcolors.ENDC, file=sys.stderr)
+        raise FileNotFoundError(args.dir)
+
+    # The series of an archive are only on disk in the split directory of a previous run
+    if args.skip_split and is_archive(args.dir) and (args.out_dcm is None or not os.path.isdir(os.path.join(args.out_dcm, split_dir_name(args.dir)))):
+        print(bcolors.FAIL, "--skip_split with an archive needs the split directory of a previous run, set it with --out_dcm", bcolors.ENDC, file=sys.stderr)
+        raise ValueError("--skip_split needs the split directory of the archive in --out_dcm")
+
+    if args.classify_only or args.dry_run:
+        args.skip_split = 1
+
+    # In --csv mode the subjects run by the same process share the matcher and its cache of series descriptions
+    matcher = shared_matcher(os.path.join(os.path.dirname(__file__), 'pattern_search_scans.csv'))
 
-    df_search = pd.read_csv(os.path.join(os.path.dirname(__file__), 'pattern_search_scans.csv'))
+    metrics = Metrics()
+    sidecars = SidecarStore()
 
+    if args.stream and not args.classify_only and not args.dry_run:
+        if is_archive(args.dir):
+            print(bcolors.WARNING, "--stream is not used with archives, the archive is already read as a stream", bcolors.ENDC)
+        else:
+            with metrics.stage('stream'):
+                series_records, series_converted, bids_info, failed = stream_convert(args, matcher, sidecars, choices, metrics)
+            metrics.subject = "sub-{bids_pid}_ses-{bids_age}".format(bids_pid=bids_info['bids_pid'], bids_age=bids_info['bids_age'])
+            finish_session(args, series_records, series_converted, bids_info, matcher, sidecars, choices, metrics)
+            check_failed(failed)
+            return
+
+    with metrics.stage('dicom_dir_split'):
+        series_description, series_files, series_records, patient_obj = dicom_dir_split(args, matcher, metrics)
+
+    bids_info = get_bids_info(args, patient_obj)
+
+    if args.classify_only:
+        classify_only(series_description, bids_info, matcher)
+        return
+
+    if args.dry_run:
+        dry_run(args, series_description, series_files, series_records, bids_info, matcher)
+        return
+
+    metrics.subject = "sub-{bids_pid}_ses-{bids_age}".format(bids_pid=bids_info['bids_pid'], bids_age=bids_info['bids_age'])
+
+    series_converted = {}
+    failed = []
     if args.skip_convert == 0:
-        series_converted = convert(args, series_description, bids_info, df_search, choices)
+        with metrics.stage('convert'):
+            series_converted, failed = convert(args, series_description, series_files, series_records, bids_info, matcher, sidecars, choices, metrics)
+
+    finish_session(args, series_records, series_converted, bids_info, matcher, sidecars, choices, metrics)
+    check_failed(failed)
+
+def check_failed(failed):
+    # The other series are converted and written, the subject is reported as failed
+    if len(failed) > 0:
+        for job in failed:
+            print(bcolors.FAIL, "Failed:", job['out_sd'], "(" + job['scan'] + "), see", job['log'], bcolors.ENDC, file=sys.stderr)
+        raise RuntimeError("{n} series failed to convert".format(n=len(failed)))
+
+def finish_session(args, series_records, series_converted, bids_info, matcher, sidecars, choices=['.nii.gz', '.nrrd'], metrics=None):
+    # Stages that run once the series are converted: scans.tsv, IntendedFor and the metrics
+    # The outputs of this and previous runs recorded in the manifest are added to the series records
+    out_bids_sub_age = os.path.join(args.out_bids, "sub-" + bids_info['bids_pid'], 'ses-' + bids_info['bids_age'])
+    manifest = ConversionManifest(os.path.join(out_bids_sub_age, MANIFEST_NAME))
+    load_manifest_records(series_records, manifest)
+
+    write_duplicate_report(series_records, out_bids_sub_age)
 
     if args.generate_tsv == 2:
-        series_converted = find_all_converted(args, series_description, bids_info, df_search, choices)
+        with metrics.stage('find_all_converted'):
+            series_converted = find_all_converted(args, series_records, bids_info, matcher, sidecars, choices)
 
     if args.generate_tsv > 0:
-        generate_tsv(args, series_files, series_converted, bids_info)
+        with metrics.stage('generate_tsv'):
+            generate_tsv(args, series_records, series_converted, bids_info, metrics)
+
+    # The outputs converted by an older version are not in the manifest, they are found in the bids directories
+    with metrics.stage('insert_intended_for_fmap'):
+        insert_intended_for_fmap(args.out_bids, bids_info, sidecars, metrics, series_records)
+
+    with metrics.stage('sidecars'):
+        sidecars.flush()
+    metrics.count('sidecars', 'json_read', sidecars.reads)
+    metrics.count('sidecars', 'json_written', sidecars.writes)
+    print(bcolors.INFO, "Sidecars:", sidecars.reads, "read,", sidecars.writes, "written", bcolors.ENDC)
+
+    write_metrics(args, metrics, bids_info)
+
+def subject_args(args, row):
+    # Each subject gets its own copy of the arguments so subjects running at the same time do not share state
+    sub_args = argparse.Namespace(**vars(args))
+    sub_args.dir = row['dir']
+    sub_args.bids_pid = row['bids_pid']
+    sub_args.bids_age = row['bids_age']
+    return sub_args
+
+def run_subject(args):
+    """Run the split and convert for one subject of the --csv file. If --log_dir is set, the output of the subject
+    (including the output of dcm2niix) goes to its own log file. Errors are caught and returned in the summary"""
+
+    summary = {'dir': args.dir, 'bids_pid': args.bids_pid, 'bids_age': args.bids_age, 'status': 'success', 'seconds': 0.0, 'log': '', 'error': ''}
+
+    stdout = sys.stdout
+    stderr = sys.stderr
+    log = None
+
+    if args.log_dir is not None:
+        summary['log'] = os.path.join(args.log_dir, "sub-{bids_pid}_ses-{bids_age}.log".format(bids_pid=args.bids_pid, bids_age=args.bids_age))
+        log = open(summary['log'], 'w', buffering=1)
+        sys.stdout = log
+        sys.stderr = log
+
+    start = time.time()
+    try:
+        print(bcolors.INFO, "Start split:", args.dir, args.bids_pid, args.bids_age, bcolors.ENDC)
+        main(args)
+    except Exception as e:
+        traceback.print_exc()
+        summary['status'] = 'failed'
+        summary['error'] = repr(e)
+    finally:
+        summary['seconds'] = round(time.time() - start, 2)
+        sys.stdout = stdout
+        sys.stderr = stderr
+        if log is not None:
+            log.close()
+
+    return summary
+
+def run_batch(args, df):
+    """Run all the subjects in the --csv file using --batch_jobs worker processes and print a summary table.
+    If --fail_fast is set, the subjects that have not started are cancelled after the first failure"""
+
+    if args.log_dir is not None and not os.path.exists(args.log_dir):
+        os.makedirs(args.log_dir)
+
+    subjects = [subject_args(args, row) for idx, row in df.iterrows()]
+    summaries = []
+
+    if args.batch_jobs <= 1:
+        for sub_args in subjects:
+            summary = run_subject(sub_args)
+            summaries.append(summary)
+            if summary['status'] == 'failed' and args.fail_fast:
+                break
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.batch_jobs) as executor:
+            futures = [executor.submit(run_subject, sub_args) for sub_args in subjects]
+            for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
+                    continue
+                summary = future.result()
+                summaries.append(summary)
+                print(bcolors.SUCCESS if summary['status'] == 'success' else bcolors.FAIL, "Done:", summary['dir'], summary['status'], bcolors.ENDC)
+                if summary['status'] == 'failed' and args.fail_fast:
+                    for f in futures:
+                        f.cancel()
+
+    # Subjects that never ran are reported as skipped, the table keeps the order of the csv file
+    done = {(s['dir'], s['bids_pid'], s['bids_age']): s for s in summaries}
+    rows = []
+    for sub_args in subjects:
+        key = (sub_args.dir, sub_args.bids_pid, sub_args.bids_age)
+        if key in done:
+            rows.append(done[key])
+        else:
+            rows.append({'dir': sub_args.dir, 'bids_pid': sub_args.bids_pid, 'bids_age': sub_args.bids_age, 'status': 'skipped', 'seconds': 0.0, 'log': '', 'error': ''})
+
+    import pandas as pd
+    summary_df = pd.DataFrame(rows)
+
+    print(bcolors.INFO, "Batch summary:", bcolors.ENDC)
+    print(summary_df[['dir', 'bids_pid', 'bids_age', 'status', 'seconds']].to_string(index=False))
+    print(bcolors.INFO, "success: {success}, failed: {failed}, skipped: {skipped}".format(success=(summary_df['status'] == 'success').sum(), failed=(summary_df['status'] == 'failed').sum(), skipped=(summary_df['status'] == 'skipped').sum()), bcolors.ENDC)
+
+    if args.metrics_out is not None:
+        # Aggregate the metrics written by the subjects of this batch
+        metrics = []
+        for row in rows:
+            out_metrics = metrics_filename(args, row['bids_pid'], row['bids_age'])
+            if row['status'] == 'success' and os.path.exists(out_metrics):
+                with open(out_metrics) as f:
+                    metrics.append(json.load(f))
+        out_metrics_summary = os.path.join(args.metrics_out, "metrics_summary" + batch_suffix(args) + ".json")
+        print(bcolors.INFO, "Writing:", out_metrics_summary, bcolors.ENDC)
+        with open(out_metrics_summary, 'w') as f:
+            json.dump(summarize(metrics), f, indent=4)
+
+    if args.log_dir is not None:
+        out_summary = os.path.join(args.log_dir, "batch_summary" + batch_suffix(args) + ".csv")
+        print(bcolors.INFO, "Writing:", out_summary, bcolors.ENDC)
+        summary_df.to_csv(out_summary, index=False)
+
+    return summary_df
+
+def estimate_subject(args):
+    """Read the headers of one subject of the --csv file and return its series with the number of files and bytes,
+    used to build the dataset index. With --index_dir the headers are saved in the header index so the --shard runs
+    do not parse them again"""
+
+    subject = {'dir': args.dir, 'bids_pid': args.bids_pid, 'bids_age': args.bids_age, 'files': 0, 'bytes': 0, 'converted_files': 0, 'converted_bytes': 0, 'series': [], 'error': ''}
+
+    try:
+        if not os.path.exists(args.dir):
+            raise FileNotFoundError(args.dir)
+
+        sub_args = argparse.Namespace(**vars(args))
+        sub_args.skip_split = 1
+
+        matcher = shared_matcher(os.path.join(os.path.dirname(__file__), 'pattern_search_scans.csv'))
+        series_description, series_files, series_records, patient_obj = dicom_dir_split(sub_args, matcher)
+
+        # The size of the members of an archive is not known, the archive size is shared by the number of files
+        archive_bytes = os.path.getsize(args.dir) if is_archive(args.dir) else None
+        total_files = sum(len(files) for files in series_files.values())
+
+        for sn_sd in sorted(series_files):
+            files = series_files[sn_sd]
+            if archive_bytes is None:
+                size = sum(os.path.getsize(f) for f in files)
+            else:
+                size = archive_bytes*len(files)//max(1, total_files)
+            scans = sorted(set(rule['scan'] for rule in matcher.match(sn_sd[1])))
+
+            subject['series'].append({'series_number': sn_sd[0], 'series_description': sn_sd[1], 'files': len(files), 'bytes': size, 'scans': scans})
+            subject['files'] += len(files)
+            subject['bytes'] += size
+            if len(scans) > 0:
+                subject['converted_files'] += len(files)
+                subject['converted_bytes'] += size
+    except Exception as e:
+        print(bcolors.FAIL, "Error reading", args.dir, e, bcolors.ENDC, file=sys.stderr)
+        subject['error'] = repr(e)
+
+    return subject
+
+def build_dataset_index(args, df):
+    """Scan all the subjects of the --csv file once (--batch_jobs at a time), split them into --shards shards of about
+    the same cost and save the result to --dataset_index"""
+
+    subjects = [subject_args(args, row) for idx, row in df.iterrows()]
+
+    print(bcolors.INFO, "Scanning", len(subjects), "subjects ...", bcolors.ENDC)
+    if args.batch_jobs <= 1:
+        estimates = [estimate_subject(sub_args) for sub_args in subjects]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.batch_jobs) as executor:
+            estimates = list(executor.map(estimate_subject, subjects))
+
+    index = DatasetIndex(estimates, cost=args.shard_cost)
+    totals = index.split(args.shards)
+
+    import pandas as pd
+    shards_df = pd.DataFrame([{
+        'shard': "{i}/{n}".format(i=i, n=args.shards),
+        'subjects': sum(1 for s in estimates if s['shard'] == i),
+        'files': sum(s['files'] for s in estimates if s['shard'] == i),
+        'bytes': sum(s['bytes'] for s in estimates if s['shard'] == i),
+        'cost': totals[i]
+        } for i in range(args.shards)])
+
+    print(bcolors.INFO, "Shards (cost: {cost}):".format(cost=args.shard_cost), bcolors.ENDC)
+    print(shards_df.to_string(index=False))
+
+    failed = [s for s in estimates if s['error'] != '']
+    if len(failed) > 0:
+        print(bcolors.WARNING, len(failed), "subjects could not be read, they are assigned with no cost:", ", ".join(s['dir'] for s in failed), bcolors.ENDC)
 
-    insert_intended_for_fmap(args.out_bids, bids_info)
+    print(bcolors.INFO, "Writing:", args.dataset_index, bcolors.ENDC)
+    index.save(args.dataset_index)
+
+    return index
+
+def select_shard(args, df):
+    # Rows of the --csv file that --shard i/N runs, from the dataset index or every N-th row if there is none
+    i, n = args.shard
+
+    if args.dataset_index is not None:
+        index = DatasetIndex.load(args.dataset_index)
+        df = index.select(df, args.shard)
+    else:
+        print(bcolors.WARNING, "No --dataset_index given, the subjects are assigned to the shards in turns", bcolors.ENDC)
+        df = df.iloc[i::n]
+
+    print(bcolors.INFO, "Shard {i}/{n}:".format(i=i, n=n), len(df), "subjects", bcolors.ENDC)
+    return df
+
+def batch_suffix(args):
+    # Shards writing to the same --log_dir or --metrics_out get their own summary files
+    if args.shard is None:
+        return ""
+    return "_shard-{i}-of-{n}".format(i=args.shard[0], n=args.shard[1])
+
+def run_merge(args, df):
+    """Merge the outputs of the --shard runs listed in --merge_shards into --out_bids and report the conflicts and the
+    subjects of the --csv file that are missing. Returns 1 if there is any conflict or missing subject"""
+
+    report = merge_shards(args.merge_shards, args.out_bids, df)
+
+    print(bcolors.INFO, "Merged {sessions} sessions, {files} files moved, {duplicates} identical files dropped".format(**report), bcolors.ENDC)
+
+    for session, dirs in report['overlapping'].items():
+        print(bcolors.WARNING, "Session in more than one shard:", session, ", ".join(dirs), bcolors.ENDC)
+
+    for conflict in report['conflicts']:
+        print(bcolors.FAIL, "Conflict:", conflict['file'], "<-", conflict['shard_file'], "(" + conflict['reason'] + ")", bcolors.ENDC, file=sys.stderr)
+
+    for subject in report['missing']:
+        print(bcolors.FAIL, "Missing:", subject['dir'], subject['bids_pid'], subject['bids_age'], bcolors.ENDC, file=sys.stderr)
+
+    if args.log_dir is not None:
+        if not os.path.exists(args.log_dir):
+            os.makedirs(args.log_dir)
+        out_report = os.path.join(args.log_dir, "merge_report.json")
+        print(bcolors.INFO, "Writing:", out_report, bcolors.ENDC)
+        with open(out_report, 'w') as f:
+            json.dump(report, f, indent=4, default=str)
+
+    return 1 if len(report['conflicts']) > 0 or len(report['missing']) > 0 else 0
 
 if __name__ == '__main__':
 
@@ -372,15 +1113,45 @@ if __name__ == '__main__':
     input_group = parser.add_argument_group('Input')
 
     input_dir_csv = input_group.add_mutually_exclusive_group(required=True)
-    input_dir_csv.add_argument('--dir', type=str, help='Input directory with DICOM files')
+    input_dir_csv.add_argument('--dir', type=str, help='Input directory with DICOM files or an archive (.zip, .tar, .tar.gz, .tgz, .tar.bz2, .tar.xz) with DICOM files')
     input_dir_csv.add_argument('--csv', default=None, type=str, help='Use this csv file to run dcm_to_bids for a whole dataset. The CSV must have columns "dir,bids_pid,bids_age". The dir column points to the directory with dicom files and bids_pid and bids_age are used to correct the id and age for the output.')
 
 
     input_group.add_argument('--skip_split', default=0, type=int, help='Skip dicom split')
+    input_group.add_argument('--header_only', default=1, type=int, help='Read only the dicom header tags needed for the split and stop before the pixel data. Set to 0 to read the full dicom files')
+    input_group.add_argument('--scan_tags', default=None, type=str, nargs='+', help='Additional dicom tags to read during the split. ' + ', '.join(SPLIT_TAGS[:-1]) + ' and ' + SPLIT_TAGS[-1] + ' are always read')
+    input_group.add_argument('--jobs', default=1, type=int, help='Number of parallel workers used to read the dicom headers')
+    input_group.add_argument('--jobs_backend', default='thread', choices=['thread', 'process'], type=str, help='Use threads (best for network file systems) or processes (best for local disks) to read the dicom headers')
+    input_group.add_argument('--index_dir', default=None, type=str, help='Directory to store a persistent index of the dicom headers (one sqlite file per input directory). On later runs only new or modified files are read')
+    input_group.add_argument('--rebuild_index', default=0, type=int, help='Discard the existing header index and read all the files again')
+    input_group.add_argument('--stream', default=0, type=int, help='For very large sessions. Walk the input directory lazily and convert each series as soon as all its files are read while the scan goes on. The memory used grows with the number of series instead of the number of files')
     input_group.add_argument('--skip_convert', default=0, type=int, help='Skip convert')
+    input_group.add_argument('--classify_only', default=0, type=int, help='Only read the dicom headers and print the bids name each series would get, nothing is split or converted')
+    input_group.add_argument('--dry_run', default=0, type=int, help='Only read the dicom headers and print the output plan: the files each series would be renamed to, the outputs that would collide or be replaced and the IntendedFor of the fieldmaps. Nothing is split, converted or written')
     input_group.add_argument('--generate_tsv', default=1, type=int, help='Generate TSV output file. skip=0, default=1 (only converted ones in current run), find=2 (finds all available scans)')
     input_group.add_argument('--use_dwi_convert', default=0, type=int, help='Use DWIConvert executable instead of dcm2niix to convert the dwi')
     input_group.add_argument('--dwi_convert', default="DWIConvert", type=str, help='Executable name of DWIConvert')
+    input_group.add_argument('--native_convert', default=None, type=str, nargs='+', help='Scan types (for example anat) converted in process with pydicom and numpy instead of dcm2niix. Only single frame series with one volume are converted this way, the others still go to dcm2niix. Writing .nii.gz needs nibabel')
+    input_group.add_argument('--dcm2niix', default="dcm2niix", type=str, help='Executable name of dcm2niix')
+    input_group.add_argument('--convert_jobs', default=1, type=int, help='Number of dcm2niix/DWIConvert processes that run at the same time. The series are independent so they can be converted concurrently')
+    input_group.add_argument('--convert_timeout', default=0, type=int, help='Seconds after which a dcm2niix/DWIConvert call is stopped and the series is considered failed. 0 (default) waits forever')
+    input_group.add_argument('--convert_retries', default=0, type=int, help='Number of times a series whose conversion failed or timed out is converted again, none by default')
+    input_group.add_argument('--convert_backoff', default=5.0, type=float, help='Seconds to wait before converting a failed series again, doubled on each retry')
+    input_group.add_argument('--force_convert', default=0, type=int, help='Convert all the series again. By default the series already converted with the same dicom files (see the manifest in the session directory) are skipped')
+
+    profile_group = parser.add_argument_group('Profiling')
+    profile_group.add_argument('--profile', default=0, type=int, help='Print the wall time, counters and external program durations of each stage at the end of each subject')
+    profile_group.add_argument('--metrics_out', default=None, type=str, help='Directory to write the metrics of each subject as json (sub-<bids_pid>_ses-<bids_age>_metrics.json). With --csv, a metrics_summary.json aggregating all the subjects is also written')
+
+    batch_group = parser.add_argument_group('Batch (--csv)')
+    batch_group.add_argument('--batch_jobs', default=1, type=int, help='Number of subjects of the --csv file processed at the same time, each subject runs in its own process')
+    batch_group.add_argument('--log_dir', default=None, type=str, help='Write the output of each subject to its own log file in this directory together with a batch_summary.csv file')
+    batch_group.add_argument('--fail_fast', default=0, type=int, help='Stop the batch after the first subject that fails. By default the remaining subjects keep running')
+    batch_group.add_argument('--dataset_index', default=None, type=str, help='Json file with the subjects of the --csv file, their series, estimated cost and shard. Built with --shards N and read by --shard i/N')
+    batch_group.add_argument('--shards', default=0, type=int, help='Scan all the subjects of the --csv file once, split them into N shards of about the same cost and write --dataset_index. Nothing is converted')
+    batch_group.add_argument('--shard_cost', default='bytes', choices=['bytes', 'files', 'converted_bytes', 'converted_files'], type=str, help='Cost used to balance the shards. converted_bytes and converted_files only count the series that match a pattern')
+    batch_group.add_argument('--shard', default=None, type=parse_shard, help='Only run the subjects of shard i out of N (0 <= i < N), for example --shard $SLURM_ARRAY_TASK_ID/8. The shards come from --dataset_index, without it every N-th subject is taken')
+    batch_group.add_argument('--merge_shards', default=None, type=str, nargs='+', help='Bids output directories of the --shard runs to merge into --out_bids. Conflicting outputs are reported and left in the shard directory, the subjects of the --csv file that are missing are reported')
 
     input_group_csv = parser.add_argument_group('Input CSV')
     input_group_csv.add_argument('--csv_id', default=None, type=str, help='Use this csv file to correct the id and age of the patient. This csv file must have column "pid" (required) and "age" (optional), it must also have columns for "bids_pid" (required) and "bids_age" (required). If this input is not provided, this convertion tool will use the patient id and age found in the dicom.')
@@ -393,6 +1164,8 @@ if __name__ == '__main__':
 
     output_group = parser.add_argument_group('Output')
     output_group.add_argument('--out_dcm', help='Output directory for dicom split', type=str, default=None)
+    output_group.add_argument('--link_mode', default='symlink', choices=['symlink', 'hardlink'], type=str, help='How the dicom files are placed in the split directories. Hard links avoid the extra lookup of a symlink and fall back to symlinks across file systems')
+    output_group.add_argument('--tmp_dir', help='Directory for the temporary series directories used when --out_dcm is not set (a node local disk is best). Defaults to the system temporary directory', type=str, default=None)
     output_group.add_argument('--out_bids', help='Output directory for bids convert', type=str, default='out_bids')
     input_group.add_argument('--out_ext', default=".nii.gz", choices=['.nii.gz', '.nrrd'], type=str, help='Output extension type')
 
@@ -400,12 +1173,23 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     if args.csv:
+        import pandas as pd
         df = pd.read_csv(args.csv, converters={'bids_pid': str, 'bids_age': str})
-        for idx, row in df.iterrows():
-            args.dir = row['dir']
-            args.bids_pid = row['bids_pid']
-            args.bids_age = row['bids_age']
-            print(bcolors.INFO, "Start split:", row, bcolors.ENDC)
-            main(args)
+
+        if args.merge_shards is not None:
+            sys.exit(run_merge(args, df))
+
+        if args.shards > 0:
+            if args.dataset_index is None:
+                parser.error("--shards needs --dataset_index")
+            build_dataset_index(args, df)
+            sys.exit(0)
+
+        if args.shard is not None:
+            df = select_shard(args, df)
+
+        summary_df = run_batch(args, df)
+        if (summary_df['status'] != 'success').any():
+            sys.exit(1)
     else:
         main(args, choices=['.nii.gz', '.nrrd'])
@@ -0,0 +1,94 @@
+import io
+import os
+import shutil
+import tarfile
+import time
+import zipfile
+
+from dicom_index import read_dicom_header
+
+ARCHIVE_EXTENSIONS = ['.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.tar', '.zip']
+
+def is_archive(path):
+    return os.path.isfile(path) and path.lower().endswith(tuple(ARCHIVE_EXTENSIONS))
+
+def split_dir_name(path):
+    # Name of the directory created in --out_dcm for the input, the archive extension is removed
+    name = os.path.basename(path)
+    for ext in ARCHIVE_EXTENSIONS:
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def read_archive_headers(archive, tags, header_only=True):
+    """Read the headers of all the members of a tar or zip archive without extracting it.
+    Returns a list of (member_name, header, error) in archive order, the same format used by read_dicom_headers.
+    Tar files are read as a stream, zip members are opened directly"""
+
+    results = []
+
+    if archive.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                try:
+                    with zf.open(info) as f:
+                        results.append((info.filename, read_dicom_header(f, tags, header_only=header_only), None))
+                except Exception as e:
+                    results.append((info.filename, None, str(e)))
+    else:
+        with tarfile.open(archive, 'r|*') as tf:
+            for member in tf:
+                if not member.isfile():
+                    continue
+                try:
+                    # The member is read in memory as a tar stream can not seek back
+                    f = io.BytesIO(tf.extractfile(member).read())
+                    results.append((member.name, read_dicom_header(f, tags, header_only=header_only), None))
+                except Exception as e:
+                    results.append((member.name, None, str(e)))
+
+    return results
+
+def is_extracted(out_file, size, mtime):
+    # Members already extracted by a previous run are not written again
+    if not os.path.exists(out_file):
+        return False
+    st = os.stat(out_file)
+    return st.st_size == size and int(st.st_mtime) == int(mtime)
+
+def extract_members(archive, targets):
+    """Extract the members of the archive given as keys of targets to the paths given as values,
+    in a single pass over the archive. The modification time of the members is preserved.
+    Returns the list of members that were not found"""
+
+    remaining = set(targets)
+
+    if archive.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.filename not in remaining:
+                    continue
+                out_file = targets[info.filename]
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                if not is_extracted(out_file, info.file_size, mtime):
+                    with zf.open(info) as f, open(out_file, 'wb') as out:
+                        shutil.copyfileobj(f, out)
+                    os.utime(out_file, (mtime, mtime))
+                remaining.discard(info.filename)
+    else:
+        with tarfile.open(archive, 'r|*') as tf:
+            for member in tf:
+                if member.name not in remaining:
+                    continue
+                out_file = targets[member.name]
+                if not is_extracted(out_file, member.size, member.mtime):
+                    with open(out_file, 'wb') as out:
+                        shutil.copyfileobj(tf.extractfile(member), out)
+                    os.utime(out_file, (member.mtime, member.mtime))
+                remaining.discard(member.name)
+                if len(remaining) == 0:
+                    break
+
+    return sorted(remaining)
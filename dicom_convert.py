@@ -0,0 +1,194 @@
+import gzip
+import json
+import os
+
+import numpy as np
+from pydicom import dcmread
+
+from dicom_index import to_python
+
+# Fields of the bids sidecar written with the image, (dicom tag, sidecar field, scale). The times are in ms in the
+# dicom and in s in the sidecar, as written by dcm2niix
+SIDECAR_FIELDS = [
+    ('Modality', 'Modality', None),
+    ('MagneticFieldStrength', 'MagneticFieldStrength', None),
+    ('Manufacturer', 'Manufacturer', None),
+    ('ManufacturerModelName', 'ManufacturersModelName', None),
+    ('InstitutionName', 'InstitutionName', None),
+    ('BodyPartExamined', 'BodyPartExamined', None),
+    ('PatientPosition', 'PatientPosition', None),
+    ('SoftwareVersions', 'SoftwareVersions', None),
+    ('MRAcquisitionType', 'MRAcquisitionType', None),
+    ('SeriesDescription', 'SeriesDescription', None),
+    ('ProtocolName', 'ProtocolName', None),
+    ('ScanningSequence', 'ScanningSequence', None),
+    ('SequenceVariant', 'SequenceVariant', None),
+    ('ScanOptions', 'ScanOptions', None),
+    ('SequenceName', 'SequenceName', None),
+    ('ImageType', 'ImageType', None),
+    ('SeriesNumber', 'SeriesNumber', None),
+    ('AcquisitionNumber', 'AcquisitionNumber', None),
+    ('SliceThickness', 'SliceThickness', None),
+    ('SpacingBetweenSlices', 'SpacingBetweenSlices', None),
+    ('EchoTime', 'EchoTime', 0.001),
+    ('RepetitionTime', 'RepetitionTime', 0.001),
+    ('InversionTime', 'InversionTime', 0.001),
+    ('FlipAngle', 'FlipAngle', None)
+]
+
+NRRD_TYPES = {'int8': 'int8', 'uint8': 'uint8', 'int16': 'short', 'uint16': 'ushort', 'int32': 'int', 'uint32': 'uint', 'float32': 'float', 'float64': 'double'}
+
+def read_series(files):
+    """Read the dicoms of a single frame series and return them sorted along the slice direction with the
+    distance of each slice. Raises ValueError for the series this converter does not handle (multi frame or mosaic
+    images, several orientations, image sizes or volumes), they are left to dcm2niix"""
+
+    datasets = [dcmread(file) for file in files]
+    if len(datasets) == 0:
+        raise ValueError("No dicom files")
+
+    first = datasets[0]
+    for ds in datasets:
+        if int(ds.get('NumberOfFrames', 1) or 1) > 1:
+            raise ValueError("Multi frame dicoms are not supported")
+        if 'MOSAIC' in [str(t).upper() for t in ds.get('ImageType', [])]:
+            raise ValueError("Mosaic images are not supported")
+        if int(ds.get('SamplesPerPixel', 1)) != 1:
+            raise ValueError("Color images are not supported")
+        for tag in ['ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing']:
+            if tag not in ds:
+                raise ValueError(tag + " is missing")
+        if (ds.Rows, ds.Columns) != (first.Rows, first.Columns):
+            raise ValueError("The images have different sizes")
+        if not np.allclose(np.array(ds.ImageOrientationPatient, dtype=float), np.array(first.ImageOrientationPatient, dtype=float), atol=1e-4):
+            raise ValueError("The images have different orientations")
+
+    orientation = np.array(first.ImageOrientationPatient, dtype=float)
+    normal = np.cross(orientation[0:3], orientation[3:6])
+
+    distances = np.array([np.dot(np.array(ds.ImagePositionPatient, dtype=float), normal) for ds in datasets])
+    order = np.argsort(distances, kind='stable')
+    datasets = [datasets[i] for i in order]
+    distances = distances[order]
+
+    if len(datasets) > 1:
+        steps = np.diff(distances)
+        if steps.min() < 1e-3:
+            raise ValueError("Several images at the same position, the series has more than one volume")
+        if steps.max() - steps.min() > 0.01*steps.mean():
+            raise ValueError("The slices are not equally spaced")
+
+    return datasets, distances
+
+def series_volume(datasets):
+    """Stack the pixel data of the sorted slices in a (columns, rows, slices) array with the rows flipped as dcm2niix
+    does, and the LPS affine of the array. The rescale slope and intercept are applied if any is not the identity,
+    the result is then float32"""
+
+    first = datasets[0]
+    last = datasets[-1]
+
+    data = np.stack([ds.pixel_array for ds in datasets])
+
+    slopes = np.array([float(ds.get('RescaleSlope', 1) or 1) for ds in datasets])
+    intercepts = np.array([float(ds.get('RescaleIntercept', 0) or 0) for ds in datasets])
+    if np.any(slopes != 1) or np.any(intercepts != 0):
+        data = data.astype(np.float32)*slopes[:, None, None].astype(np.float32) + intercepts[:, None, None].astype(np.float32)
+    elif data.dtype == np.uint16 and data.max(initial=0) <= np.iinfo(np.int16).max:
+        data = data.astype(np.int16)
+
+    # (slices, rows, columns) to (columns, rows, slices), the first row of the dicom is the last one of the volume
+    volume = np.transpose(data, (2, 1, 0))[:, ::-1, :]
+
+    orientation = np.array(first.ImageOrientationPatient, dtype=float)
+    row_spacing, column_spacing = [float(s) for s in first.PixelSpacing]
+    position = np.array(first.ImagePositionPatient, dtype=float)
+
+    if len(datasets) > 1:
+        slice_step = (np.array(last.ImagePositionPatient, dtype=float) - position)/(len(datasets) - 1)
+    else:
+        slice_step = np.cross(orientation[0:3], orientation[3:6])*float(first.get('SliceThickness', 1) or 1)
+
+    affine = np.eye(4)
+    affine[0:3, 0] = orientation[0:3]*column_spacing
+    affine[0:3, 1] = -orientation[3:6]*row_spacing
+    affine[0:3, 2] = slice_step
+    affine[0:3, 3] = position + orientation[3:6]*row_spacing*(first.Rows - 1)
+
+    return np.ascontiguousarray(volume), affine
+
+def bids_sidecar(ds):
+    # Sidecar of the series from the header of its first slice
+    sidecar = {}
+    for tag, field, scale in SIDECAR_FIELDS:
+        value = ds.get(tag)
+        if value is None or value == '':
+            continue
+        value = to_python(value)
+        if scale is not None:
+            value = float(value)*scale
+        if tag in ['ScanningSequence', 'SequenceVariant', 'ScanOptions'] and isinstance(value, list):
+            value = '_'.join(value)
+        sidecar[field] = value
+
+    acquisition_time = str(ds.get('AcquisitionTime', ''))
+    if acquisition_time != '':
+        fraction = acquisition_time.split('.', 1)[1] if '.' in acquisition_time else ''
+        sidecar['AcquisitionTime'] = "{}:{}:{}.{}".format(acquisition_time[0:2], acquisition_time[2:4], acquisition_time[4:6], fraction.ljust(6, '0')[0:6])
+
+    sidecar['ImageOrientationPatientDICOM'] = [float(v) for v in ds.ImageOrientationPatient]
+    sidecar['ConversionSoftware'] = 'dcm_to_bids'
+
+    return sidecar
+
+def write_nifti(filename, volume, affine):
+    # nibabel is only needed by this converter, dcm2niix is used when it is not installed
+    import nibabel as nib
+
+    # dicom LPS to nifti RAS
+    affine = np.diag([-1, -1, 1, 1]).dot(affine)
+
+    img = nib.Nifti1Image(volume, affine)
+    img.header.set_xyzt_units('mm', 'sec')
+    img.header.set_qform(affine, code=1)
+    img.header.set_sform(affine, code=1)
+    nib.save(img, filename)
+
+def write_nrrd(filename, volume, affine):
+
+    directions = " ".join("({})".format(",".join(repr(float(v)) for v in affine[0:3, i])) for i in range(3))
+    header = [
+        "NRRD0004",
+        "type: " + NRRD_TYPES[volume.dtype.name],
+        "dimension: 3",
+        "space: left-posterior-superior",
+        "sizes: " + " ".join(str(s) for s in volume.shape),
+        "space directions: " + directions,
+        "kinds: domain domain domain",
+        "endian: little",
+        "encoding: gzip",
+        "space origin: ({})".format(",".join(repr(float(v)) for v in affine[0:3, 3]))
+        ]
+
+    with open(filename, 'wb') as f:
+        f.write(("\n".join(header) + "\n\n").encode())
+        f.write(gzip.compress(volume.astype(volume.dtype.newbyteorder('<')).tobytes(order='F'), compresslevel=6))
+
+def convert_series(files, out_dir, name, ext='.nii.gz'):
+    """Convert a single frame series to out_dir/name + ext (.nii.gz or .nrrd) and its json sidecar, in process with
+    pydicom and numpy. Returns the written files, raises ValueError if the series is not supported"""
+
+    datasets, distances = read_series(files)
+    volume, affine = series_volume(datasets)
+
+    out_image = os.path.join(out_dir, name + ext)
+    if ext == '.nrrd':
+        write_nrrd(out_image, volume, affine)
+    else:
+        write_nifti(out_image, volume, affine)
+
+    out_json = os.path.join(out_dir, name + '.json')
+    with open(out_json, 'w') as f:
+        json.dump(bids_sidecar(datasets[0]), f, indent=4)
+
+    return [out_image, out_json]
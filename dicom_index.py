@@ -0,0 +1,211 @@
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import stat
+
+# Tags that are always read when splitting a session. SeriesNumber/SeriesDescription group the files,
+# PatientID/PatientAge fill the bids id and age, AcquisitionDate/AcquisitionTime are used for the scans.tsv file
+# InstanceNumber sorts the files inside each series and SeriesInstanceUID identifies the series in the conversion manifest
+# SOPInstanceUID finds the files of a series that are copies of the same image (re-sends, duplicate PACS pushes)
+SPLIT_TAGS = ['SeriesNumber', 'SeriesDescription', 'PatientID', 'PatientAge', 'AcquisitionDate', 'AcquisitionTime', 'InstanceNumber', 'SeriesInstanceUID', 'SOPInstanceUID']
+
+def scan_tags(extra_tags=None):
+    # Returns the list of tags to read, the required ones first followed by the user provided ones
+    tags = list(SPLIT_TAGS)
+    if extra_tags is not None:
+        tags += [tag for tag in extra_tags if tag not in tags]
+    return tags
+
+def to_python(value):
+    # Converts pydicom values to plain python types so the headers can be compared, sorted or serialized
+    if isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+
+    # pydicom is loaded once a dicom is read, not when the headers come from the index
+    from pydicom.multival import MultiValue
+    from pydicom.valuerep import PersonName
+    if isinstance(value, MultiValue):
+        return [to_python(v) for v in value]
+    if isinstance(value, PersonName):
+        return str(value)
+    return value
+
+def read_dicom_header(file, tags, header_only=True):
+    """Read the given tags from a dicom file and return them as a dictionary.
+    If header_only is set, parsing stops before the pixel data and only the requested tags are decoded,
+    otherwise the full dataset is read. Raises an error if the file is not a dicom"""
+
+    from pydicom import dcmread
+
+    if header_only:
+        ds = dcmread(file, stop_before_pixels=True, specific_tags=tags)
+    else:
+        ds = dcmread(file)
+
+    header = {}
+    for tag in tags:
+        if tag in ds:
+            value = ds[tag].value
+            if not isinstance(value, bytes):
+                header[tag] = to_python(value)
+
+    return header
+
+def read_dicom_header_task(file, tags, header_only=True):
+    # Worker used by read_dicom_headers. Directories are skipped and errors are returned instead of raised
+    # so a single bad file does not stop the pool
+    if not os.path.isfile(file):
+        return None, None
+    try:
+        return read_dicom_header(file, tags, header_only=header_only), None
+    except Exception as e:
+        return None, str(e)
+
+def read_dicom_headers(files, tags, header_only=True, jobs=1, backend='thread', executor=None):
+    """Read the headers of all files, using a pool of threads or processes when jobs > 1 or the given executor.
+    Returns a list of (file, header, error) in the same order as files. The header is None for directories and
+    for files that are not dicoms, in which case error is set"""
+
+    task = functools.partial(read_dicom_header_task, tags=tags, header_only=header_only)
+
+    if executor is not None:
+        results = list(executor.map(task, files))
+    elif jobs <= 1:
+        results = map(task, files)
+    elif backend == 'process':
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(task, files, chunksize=max(1, len(files)//(jobs*16))))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(task, files))
+
+    return [(file, header, error) for file, (header, error) in zip(files, results)]
+
+def instance_sort_key(file, header):
+    # Files are sorted by InstanceNumber, the path breaks ties and orders files without InstanceNumber
+    instance_number = header.get('InstanceNumber')
+    if instance_number is None:
+        return (1, 0, file)
+    return (0, instance_number, file)
+
+def drop_duplicates(files, file_headers):
+    """Keep the first file of each SOPInstanceUID, files are copies of the same image if they have the same one.
+    Returns the files kept, in the same order, and the list of (duplicate, file kept). Files without SOPInstanceUID are kept"""
+
+    kept = []
+    duplicates = []
+    first = {}
+
+    for file in files:
+        sop_uid = file_headers[file].get('SOPInstanceUID')
+        if sop_uid is not None and sop_uid in first:
+            duplicates.append((file, first[sop_uid]))
+            continue
+        if sop_uid is not None:
+            first[sop_uid] = file
+        kept.append(file)
+
+    return kept, duplicates
+
+class HeaderIndex:
+    """Persistent index of the dicom headers found in a directory, stored in a sqlite file.
+    Each entry is keyed by the path relative to the directory and keeps the size and modification time of the file,
+    an entry is only reused if both are unchanged. Files that are not dicoms are also recorded so they are not parsed again"""
+
+    def __init__(self, filename, root, tags, rebuild=False):
+        self.filename = filename
+        self.root = root
+        self.tags = tags
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, header TEXT, error TEXT)")
+
+        # The index is dropped if it was built with fewer tags than the ones requested now or for another directory,
+        # the paths are relative to the root so the entries of another directory could match files of this one
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'tags'").fetchone()
+        root_row = self.conn.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+        if rebuild or row is None or not set(tags).issubset(json.loads(row[0])) or root_row is None or root_row[0] != os.path.abspath(root):
+            self.conn.execute("DELETE FROM headers")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('tags', ?)", (json.dumps(tags),))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('root', ?)", (os.path.abspath(root),))
+            self.conn.commit()
+
+    def relpath(self, file):
+        return os.path.relpath(file, self.root)
+
+    def lookup(self, files):
+        # Returns {file: (header, error)} for the files with an up to date entry and the list of stats for the rest
+        entries = {path: (size, mtime_ns, header, error) for path, size, mtime_ns, header, error in self.conn.execute("SELECT path, size, mtime_ns, header, error FROM headers")}
+
+        found = {}
+        stats = {}
+        for file in files:
+            try:
+                st = os.stat(file)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                found[file] = (None, None)
+                continue
+
+            stats[file] = (st.st_size, st.st_mtime_ns)
+            entry = entries.get(self.relpath(file))
+            if entry is not None and entry[0:2] == stats[file]:
+                header = json.loads(entry[2]) if entry[2] is not None else None
+                found[file] = (header, entry[3])
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return found, stats
+
+    def update(self, results, stats):
+        rows = []
+        for file, header, error in results:
+            if file in stats:
+                size, mtime_ns = stats[file]
+                rows.append((self.relpath(file), size, mtime_ns, json.dumps(header) if header is not None else None, error))
+        self.conn.executemany("INSERT OR REPLACE INTO headers (path, size, mtime_ns, header, error) VALUES (?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+    def prune(self, files):
+        # Removes the entries of files that no longer exist in the directory, only the entries under the root
+        paths = set(self.relpath(file) for file in files)
+        stale = [(path,) for path, in self.conn.execute("SELECT path FROM headers") if path not in paths and not path.startswith(os.pardir + os.sep)]
+        self.conn.executemany("DELETE FROM headers WHERE path = ?", stale)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def index_filename(index_dir, dir):
+    # One index file per input directory, named after the directory and a hash of its absolute path, so the sessions of
+    # a dataset with the same directory name (<subject>/DICOM) get their own file
+    path = os.path.abspath(dir)
+    return os.path.join(index_dir, "{name}_{hash}_index.sqlite".format(name=os.path.basename(path), hash=hashlib.sha1(path.encode()).hexdigest()[:12]))
+
+def read_dicom_headers_indexed(files, tags, index, header_only=True, jobs=1, backend='thread'):
+    """Same as read_dicom_headers but only the files that are new or changed since the index was
+    built are parsed, the index is updated with the results"""
+
+    found, stats = index.lookup(files)
+
+    to_read = [file for file in files if file not in found]
+    results = read_dicom_headers(to_read, tags, header_only=header_only, jobs=jobs, backend=backend)
+    index.update(results, stats)
+    index.prune(files)
+
+    read = {file: (header, error) for file, header, error in results}
+    found.update(read)
+
+    return [(file,) + found[file] for file in files if file in found]
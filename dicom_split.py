@@ -0,0 +1,293 @@
+import errno
+import glob
+import os
+import sys
+
+from dicom_archive import extract_members, is_archive, read_archive_headers, split_dir_name
+from dicom_index import HeaderIndex, drop_duplicates, index_filename, instance_sort_key, read_dicom_headers, read_dicom_headers_indexed, scan_tags
+from dicom_stream import SeriesStream
+from profiling import metrics_requested
+from series import SeriesRecord
+
+class bcolors:
+    HEADER = '\033[95m'
+    OK = '\033[94m'
+    INFO = '\033[96m'
+    SUCCESS = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+def split_file_name(out_dcm, out_sd, sf):
+    # Name of the file in the split directory, files without extension get .dcm
+    out_sf = os.path.join(out_dcm, out_sd, os.path.basename(sf))
+
+    if os.path.splitext(out_sf)[1] == '':
+        out_sf += ".dcm"
+
+    return out_sf
+
+def link_series(sfs, out_dir, link_mode='symlink'):
+    """Link the files of a series into out_dir, the directory must exist. With link_mode hardlink, files on
+    a different file system than out_dir are symlinked instead. Returns the number of files linked"""
+
+    linked = 0
+
+    for sf in sfs:
+
+        out_sf = split_file_name(os.path.dirname(out_dir), os.path.basename(out_dir), sf)
+
+        try:
+
+            sf = os.path.abspath(sf)
+
+            if link_mode == 'hardlink':
+                try:
+                    os.link(sf, out_sf)
+                    linked += 1
+                    continue
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+
+            os.symlink(sf, out_sf)
+            linked += 1
+
+        except:
+            print(bcolors.FAIL, "Error linking file", sf, bcolors.ENDC, file=sys.stderr)
+
+    return linked
+
+def extract_archive_series(args, out_dcm, series_files, series_description, matcher=None):
+    """Extract the members of the series that match a pattern (all the series if there is no matcher)
+    directly in the split directories. Returns series_files with the paths of the extracted files,
+    the series that are not extracted keep the names of the archive members"""
+
+    if matcher is not None:
+        classification = matcher.classify(series_description)
+        selected = [sn_sd for sn_sd in series_description if len(classification['matches'][sn_sd]) > 0]
+    else:
+        selected = list(series_description)
+
+    targets = {}
+    out_files = set()
+    extracted_files = dict(series_files)
+
+    for sn_sd in selected:
+
+        sn, sd = sn_sd
+        out_sd = str(sn) + "_" + sd
+        out_dir = os.path.join(out_dcm, out_sd)
+
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        extracted_files[sn_sd] = []
+        for sf in series_files[sn_sd]:
+            out_sf = split_file_name(out_dcm, out_sd, sf)
+            if out_sf in out_files:
+                print(bcolors.FAIL, "Error extracting file, the name already exists", sf, bcolors.ENDC, file=sys.stderr)
+                continue
+            targets[sf] = out_sf
+            out_files.add(out_sf)
+            extracted_files[sn_sd].append(out_sf)
+
+    print(bcolors.INFO, "Extracting", len(targets), "files of", len(selected), "series from", args.dir, "...", bcolors.ENDC)
+    for sf in extract_members(args.dir, targets):
+        print(bcolors.FAIL, "Error extracting file", sf, bcolors.ENDC, file=sys.stderr)
+
+    return extracted_files
+
+def extracted_series_files(out_dcm, series_files):
+    """Paths of the archive members in the split directory of a previous run (--skip_split), the series without a split
+    directory (not extracted) keep the names of the archive members"""
+
+    extracted_files = dict(series_files)
+
+    for sn_sd in series_files:
+        out_sd = str(sn_sd[0]) + "_" + sn_sd[1]
+        if os.path.isdir(os.path.join(out_dcm, out_sd)):
+            extracted_files[sn_sd] = [split_file_name(out_dcm, out_sd, sf) for sf in series_files[sn_sd]]
+
+    return extracted_files
+
+def report_duplicates(series_records, metrics=None, stage='dicom_dir_split'):
+    for sn_sd in sorted(series_records):
+        duplicates = series_records[sn_sd].duplicates
+        if len(duplicates) > 0:
+            print(bcolors.WARNING, "Series", str(sn_sd[0]) + "_" + sn_sd[1], "has", len(duplicates), "duplicate files (same SOPInstanceUID), converting", series_records[sn_sd].file_count, "files", bcolors.ENDC)
+            if metrics is not None:
+                metrics.count(stage, 'duplicates', len(duplicates))
+
+def check_series_uids(sn_sd, headers):
+    # Different series (SeriesInstanceUID) with the same series number and description end up in the same series
+    series_uids = sorted(set(h['SeriesInstanceUID'] for h in headers if h.get('SeriesInstanceUID') is not None))
+    if len(series_uids) > 1:
+        print(bcolors.WARNING, "WARNING: The files of", str(sn_sd[0]) + "_" + sn_sd[1], "belong to", len(series_uids), "different series (SeriesInstanceUID):", ", ".join(series_uids), bcolors.ENDC, file=sys.stderr)
+
+def dicom_dir_split(args, matcher=None, metrics=None):
+
+    series_description = {}
+    series_files = {}
+    series_records = {}
+    patient_id = ''
+    patient_age = ''
+
+    tags = scan_tags(args.scan_tags)
+
+    # The headers are read in parallel but the results come back in the order of the file list
+    file_headers = {}
+
+    archive = is_archive(args.dir)
+
+    if archive:
+        # The members of the archive are parsed directly from the archive without extracting it
+        print(bcolors.INFO, "Reading archive:", args.dir, bcolors.ENDC)
+        headers = read_archive_headers(args.dir, tags, header_only=args.header_only)
+    elif args.index_dir is not None:
+        files = glob.glob(os.path.join(args.dir, '**'), recursive = True)
+        if not os.path.exists(args.index_dir):
+            os.makedirs(args.index_dir)
+        index = HeaderIndex(index_filename(args.index_dir, args.dir), args.dir, tags, rebuild=args.rebuild_index)
+        headers = read_dicom_headers_indexed(files, tags, index, header_only=args.header_only, jobs=args.jobs, backend=args.jobs_backend)
+        index.close()
+        print(bcolors.INFO, "Header index:", index.filename, "hits:", index.hits, "misses:", index.misses, bcolors.ENDC)
+        if metrics is not None:
+            metrics.count('dicom_dir_split', 'index_hits', index.hits)
+            metrics.count('dicom_dir_split', 'index_misses', index.misses)
+    else:
+        files = glob.glob(os.path.join(args.dir, '**'), recursive = True)
+        headers = read_dicom_headers(files, tags, header_only=args.header_only, jobs=args.jobs, backend=args.jobs_backend)
+
+    for file, ds, error in headers:
+        try:
+            if error is not None:
+                raise ValueError(error)
+            if ds is not None:
+                sn = ds['SeriesNumber']
+                sd = ds['SeriesDescription']
+
+                sn_sd = (sn, sd)
+
+                if(patient_id == ''):
+                    patient_id = ds['PatientID']
+
+                if(patient_age == ''):
+                    patient_age = ds['PatientAge']
+
+                if sn_sd not in series_description:
+                    series_description[sn_sd] = sd
+                    series_files[sn_sd] = []
+
+                series_files[sn_sd].append(file)
+                file_headers[file] = ds
+        except:
+            print(bcolors.FAIL, "Not a dicom file:", file, bcolors.ENDC, file=sys.stderr)
+
+    if metrics is not None:
+        metrics.count('dicom_dir_split', 'files', len(headers))
+        metrics.count('dicom_dir_split', 'dicoms', len(file_headers))
+        metrics.count('dicom_dir_split', 'series', len(series_files))
+        # Size of the input files, the headers read stop before the pixel data
+        if metrics_requested(args):
+            if archive:
+                metrics.count('dicom_dir_split', 'input_bytes', os.path.getsize(args.dir))
+            else:
+                metrics.count('dicom_dir_split', 'input_bytes', sum(os.path.getsize(f) for f in file_headers))
+
+    # Sort the files of each series by InstanceNumber so the output does not depend on the directory listing
+    # Copies of the same image (same SOPInstanceUID) are dropped so they are not linked nor converted twice
+    # A record of each series is built from the header of its first file, the later stages use it instead of reading the dicoms again
+    for sn_sd in series_files:
+        series_files[sn_sd].sort(key=lambda f: instance_sort_key(f, file_headers[f]))
+        series_files[sn_sd], duplicates = drop_duplicates(series_files[sn_sd], file_headers)
+        series_records[sn_sd] = SeriesRecord.from_header(file_headers[series_files[sn_sd][0]], len(series_files[sn_sd]))
+        series_records[sn_sd].duplicates = duplicates
+        check_series_uids(sn_sd, [file_headers[f] for f in series_files[sn_sd]])
+
+    report_duplicates(series_records, metrics, 'dicom_dir_split')
+
+    if args.skip_split:
+        if archive and args.out_dcm is not None:
+            series_files = extracted_series_files(os.path.join(args.out_dcm, split_dir_name(args.dir)), series_files)
+        return series_description, series_files, series_records, {'patient_id': patient_id, 'patient_age': patient_age}
+
+    if args.out_dcm is None:
+        if archive:
+            print(bcolors.FAIL, "Please set a valid output directory for the dicom split using --out_dcm flag", bcolors.ENDC, file=sys.stderr)
+            raise ValueError("--out_dcm is required to split an archive")
+        # Without --out_dcm no directories are created here, each series is linked to a temporary directory right before its conversion
+        print(bcolors.INFO, "No --out_dcm given, skipping the split directories", bcolors.ENDC)
+        return series_description, series_files, series_records, {'patient_id': patient_id, 'patient_age': patient_age}
+
+    out_dcm = os.path.join(args.out_dcm, split_dir_name(args.dir))
+
+    if archive:
+        series_files = extract_archive_series(args, out_dcm, series_files, series_description, matcher)
+        print(bcolors.SUCCESS, "Dicom split done!", bcolors.ENDC)
+        return series_description, series_files, series_records, {'patient_id': patient_id, 'patient_age': patient_age}
+
+    print(bcolors.INFO, "Generating directories ...", bcolors.ENDC)
+
+    for sn_sd in series_description:
+
+        sn, sd = sn_sd
+
+        out_sd = str(sn) + "_" + sd
+        out_dir = os.path.join(out_dcm, out_sd)
+
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+
+    print(bcolors.INFO, "linking dicoms ...", bcolors.ENDC)
+    for sn_sd in series_description:
+
+        sn, sd = sn_sd
+        out_sd = str(sn) + "_" + sd
+
+        linked = link_series(series_files[sn_sd], os.path.join(out_dcm, out_sd), args.link_mode)
+        if metrics is not None:
+            metrics.count('dicom_dir_split', 'links', linked)
+
+        print(bcolors.SUCCESS, "link:", linked, "files ->", os.path.join(out_dcm, out_sd), bcolors.ENDC)
+
+    print(bcolors.SUCCESS, "Dicom split done!", bcolors.ENDC)
+    return series_description, series_files, series_records, {'patient_id': patient_id, 'patient_age': patient_age}
+
+def stream_dicom_dir_split(args):
+    """Split very large directories (--stream 1). The tree is walked lazily and each series is linked as soon as all its
+    files are read, only the files of the open series are kept in memory"""
+
+    out_dcm = os.path.join(args.out_dcm, split_dir_name(args.dir))
+    stream = SeriesStream(args.dir, scan_tags(args.scan_tags), header_only=args.header_only, jobs=args.jobs, backend=args.jobs_backend)
+
+    for sn_sd, files, header in stream:
+
+        sn, sd = sn_sd
+        out_dir = os.path.join(out_dcm, str(sn) + "_" + sd)
+
+        duplicates = stream.duplicates.pop(sn_sd, [])
+        if len(duplicates) > 0:
+            print(bcolors.WARNING, "Series", str(sn) + "_" + sd, "has", len(duplicates), "duplicate files (same SOPInstanceUID), linking", len(files), "files", bcolors.ENDC)
+
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        linked = link_series(files, out_dir, args.link_mode)
+        print(bcolors.SUCCESS, "link:", linked, "files ->", out_dir, bcolors.ENDC)
+
+    # Files of a series found after it was linked are linked now
+    for sn_sd in sorted(stream.late):
+        sn, sd = sn_sd
+        out_sd = str(sn) + "_" + sd
+        files, header = stream.collect(sn_sd)
+        duplicates = stream.duplicates.pop(sn_sd, [])
+        if len(duplicates) > 0:
+            print(bcolors.WARNING, "Series", out_sd, "has", len(duplicates), "duplicate files (same SOPInstanceUID), linking", len(files), "files", bcolors.ENDC)
+        linked = link_series([f for f in files if not os.path.lexists(split_file_name(out_dcm, out_sd, f))], os.path.join(out_dcm, out_sd), args.link_mode)
+        print(bcolors.SUCCESS, "link:", linked, "more files ->", os.path.join(out_dcm, out_sd), bcolors.ENDC)
+
+    print(bcolors.SUCCESS, "Dicom split done!", bcolors.ENDC)
@@ -0,0 +1,215 @@
+import concurrent.futures
+import os
+import sys
+from array import array
+
+from dicom_index import drop_duplicates, instance_sort_key, read_dicom_headers
+
+def scan_directories(root):
+    """Walk the tree under root lazily with os.scandir, depth first and in name order.
+    Yields (directory, file names) for every directory. Hidden files and directories are skipped as glob does"""
+
+    stack = [root]
+
+    while len(stack) > 0:
+        directory = stack.pop()
+        names = []
+        subdirs = []
+
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    else:
+                        names.append(entry.name)
+        except OSError as e:
+            print("Error reading directory:", directory, e, file=sys.stderr)
+            continue
+
+        yield directory, sorted(names)
+        stack.extend(sorted(subdirs, reverse=True))
+
+class PathTable:
+    # Directory prefixes stored once, a file is kept as the index of its directory and its name
+    def __init__(self):
+        self.dirs = []
+        self.ids = {}
+
+    def intern(self, directory):
+        if directory not in self.ids:
+            self.ids[directory] = len(self.dirs)
+            self.dirs.append(directory)
+        return self.ids[directory]
+
+    def path(self, dir_id, name):
+        return os.path.join(self.dirs[dir_id], name)
+
+# InstanceNumber stored for files without one
+NO_INSTANCE = -2**63
+
+class OpenSeries:
+    # Files of a series found so far with their InstanceNumber, and the header of the first file in instance order
+    # Files with the SOPInstanceUID of a file already found are kept apart as (duplicate, position of the file kept)
+    __slots__ = ['dir_ids', 'names', 'instances', 'header', 'header_key', 'sop_uids', 'duplicates']
+
+    def __init__(self):
+        self.dir_ids = array('I')
+        self.names = []
+        self.instances = array('q')
+        self.header = None
+        self.header_key = None
+        self.sop_uids = {}
+        self.duplicates = []
+
+    def add(self, dir_id, name, file, header):
+        sop_uid = header.get('SOPInstanceUID')
+        if sop_uid is not None:
+            if sop_uid in self.sop_uids:
+                self.duplicates.append((file, self.sop_uids[sop_uid]))
+                return
+            self.sop_uids[sop_uid] = len(self.names)
+
+        self.dir_ids.append(dir_id)
+        self.names.append(name)
+        instance_number = header.get('InstanceNumber')
+        self.instances.append(int(instance_number) if instance_number is not None else NO_INSTANCE)
+        key = instance_sort_key(file, header)
+        if self.header_key is None or key < self.header_key:
+            self.header = header
+            self.header_key = key
+
+    def files(self, paths):
+        # Same order as instance_sort_key
+        files = [(paths.path(dir_id, name), instance_number) for dir_id, name, instance_number in zip(self.dir_ids, self.names, self.instances)]
+        files.sort(key=lambda f: (1, 0, f[0]) if f[1] == NO_INSTANCE else (0, f[1], f[0]))
+        return [file for file, instance_number in files]
+
+    def duplicate_files(self, paths):
+        return [(duplicate, paths.path(self.dir_ids[i], self.names[i])) for duplicate, i in self.duplicates]
+
+class SeriesStream:
+    """Reads the dicom headers while the directory tree is walked and yields (sn_sd, files, header) for each series
+    as soon as it is finished, the files sorted by InstanceNumber and the header of the first one.
+    A series is finished when a directory without files of the series has been read after it, so a series spread over
+    consecutive directories (as the DIR000, DIR001 of some exports) is still yielded once. Only the files of the open
+    series are kept, the memory grows with the number of series and directories, not files.
+    Files of a series found after it was yielded are not yielded, the series is added to late and collect()
+    reads its directories again to return all the files. Copies of the same image (same SOPInstanceUID) are dropped,
+    duplicates has the (duplicate, file kept) pairs of the series yielded until they are popped. With sizes the size of
+    the dicom files is added to input_bytes"""
+
+    def __init__(self, root, tags, header_only=True, jobs=1, backend='thread', sizes=False):
+        self.root = root
+        self.tags = tags
+        self.header_only = header_only
+        self.jobs = jobs
+        self.backend = backend
+        self.sizes = sizes
+
+        self.paths = PathTable()
+        self.open = {}
+        self.series_dirs = {}
+        self.finished = set()
+        self.late = set()
+        self.duplicates = {}
+
+        self.patient_id = ''
+        self.patient_age = ''
+        self.files = 0
+        self.dicoms = 0
+        self.input_bytes = 0
+        self.errors = 0
+
+    def executor(self):
+        if self.jobs <= 1:
+            return None
+        if self.backend == 'process':
+            return concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs)
+        return concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+
+    def read_directory(self, directory, names, executor=None):
+        files = [os.path.join(directory, name) for name in names]
+        return read_dicom_headers(files, self.tags, header_only=self.header_only, jobs=1, executor=executor)
+
+    def add(self, dir_id, name, file, header):
+        sn_sd = (header['SeriesNumber'], header['SeriesDescription'])
+
+        if self.patient_id == '':
+            self.patient_id = header['PatientID']
+        if self.patient_age == '':
+            self.patient_age = header['PatientAge']
+
+        if sn_sd in self.finished:
+            self.late.add(sn_sd)
+        elif sn_sd not in self.open:
+            self.open[sn_sd] = OpenSeries()
+
+        if sn_sd in self.open:
+            self.open[sn_sd].add(dir_id, name, file, header)
+
+        self.series_dirs.setdefault(sn_sd, set()).add(dir_id)
+        return sn_sd
+
+    def close(self, sn_sd):
+        series = self.open.pop(sn_sd)
+        self.finished.add(sn_sd)
+        if len(series.duplicates) > 0:
+            self.duplicates[sn_sd] = series.duplicate_files(self.paths)
+        return sn_sd, series.files(self.paths), series.header
+
+    def __iter__(self):
+
+        executor = self.executor()
+
+        try:
+            for directory, names in scan_directories(self.root):
+
+                dir_id = self.paths.intern(directory)
+                seen = set()
+
+                for file, header, error in self.read_directory(directory, names, executor):
+                    self.files += 1
+                    try:
+                        if error is not None:
+                            raise ValueError(error)
+                        if header is not None:
+                            seen.add(self.add(dir_id, os.path.basename(file), file, header))
+                            self.dicoms += 1
+                            if self.sizes:
+                                self.input_bytes += os.path.getsize(file)
+                    except Exception:
+                        self.errors += 1
+                        print("Not a dicom file:", file, file=sys.stderr)
+
+                # Series that did not get files in this directory are finished
+                if len(names) > 0:
+                    for sn_sd in sorted(set(self.open) - seen):
+                        yield self.close(sn_sd)
+
+            for sn_sd in sorted(self.open):
+                yield self.close(sn_sd)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def patient(self):
+        return {'patient_id': self.patient_id, 'patient_age': self.patient_age}
+
+    def collect(self, sn_sd):
+        """Read again the directories where files of the series were found and return (files, header) with all the
+        files of the series sorted by InstanceNumber, without the duplicates"""
+
+        file_headers = {}
+        for dir_id in sorted(self.series_dirs[sn_sd]):
+            directory = self.paths.dirs[dir_id]
+            names = sorted(entry.name for entry in os.scandir(directory) if not entry.name.startswith('.') and entry.is_file())
+            for file, header, error in self.read_directory(directory, names):
+                if header is not None and (header['SeriesNumber'], header['SeriesDescription']) == sn_sd:
+                    file_headers[file] = header
+
+        files = sorted(file_headers, key=lambda f: instance_sort_key(f, file_headers[f]))
+        files, self.duplicates[sn_sd] = drop_duplicates(files, file_headers)
+        return files, file_headers[files[0]]
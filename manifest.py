@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+
+# Name of the manifest file in the session directory of the bids output
+MANIFEST_NAME = '.dcm_to_bids_manifest.json'
+
+class ConversionManifest:
+    """Record of the series converted for a session, stored as a json file in the session directory of the bids output.
+    Each entry is keyed by the SeriesInstanceUID and the pattern used to convert it, and keeps a fingerprint of the dicom
+    files of the series together with the output files. A series is up to date if the fingerprint and the run number
+    did not change and all the outputs still exist. inputs has the fingerprints of the series of the input read by the
+    current run, an entry whose fingerprint is not one of them is stale (the session was exported again with new
+    SeriesInstanceUIDs, or the series is gone)"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.inputs = set()
+
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.entries = json.load(f).get('series', {})
+
+    @staticmethod
+    def key(series_uid, rule):
+        return "{series_uid}|{scan}/{out_name}".format(series_uid=series_uid, scan=rule['scan'], out_name=rule['out_name'])
+
+    @staticmethod
+    def fingerprint(files):
+        # Hash of the name, size and modification time of every file in the series, the content is not read
+        h = hashlib.sha1()
+        for file in sorted(files):
+            st = os.stat(file)
+            h.update("{name}\0{size}\0{mtime}\n".format(name=os.path.basename(file), size=st.st_size, mtime=st.st_mtime_ns).encode())
+        return h.hexdigest()
+
+    def lookup(self, key, fingerprint, run_number):
+        # Returns the entry if the series was converted with the same files and run number and the outputs exist,
+        # a run_number of None accepts any run number
+        entry = self.entries.get(key)
+        if entry is None or entry['fingerprint'] != fingerprint or (run_number is not None and entry['run_number'] != run_number):
+            return None
+        root = os.path.dirname(self.filename)
+        if len(entry['outputs']) == 0 or not all(os.path.exists(os.path.join(root, output)) for output in entry['outputs']):
+            return None
+        return entry
+
+    def stale(self, key):
+        return self.entries[key]['fingerprint'] not in self.inputs
+
+    def record(self, key, entry):
+        self.entries[key] = entry
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+    def save(self):
+        # Written to a temporary file first so an interrupted run never leaves a truncated manifest
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'series': self.entries}, f, indent=4, sort_keys=True)
+        os.replace(tmp, self.filename)
@@ -0,0 +1,170 @@
+import os
+
+def output_ext(file):
+    ext = os.path.splitext(file)[1]
+    if ext == ".gz":
+        ext = ".nii.gz"
+    return ext
+
+def intended_for(outputs, bids_age):
+    """IntendedFor of the fieldmaps from the outputs of a session (paths relative to the session directory).
+    Returns the fieldmap sidecars and the list of images they are intended for: the func images (without the sbref)
+    and the dwi images, relative to the subject directory"""
+
+    json_files = sorted(f for f in outputs if f.split(os.path.sep)[0] == "fmap" and f.endswith(".json"))
+    nii_files = ["ses-{bids_age}/{file}".format(bids_age=bids_age, file=f) for f in sorted(outputs) if f.split(os.path.sep)[0] == "func" and f.endswith(".nii.gz") and "sbref" not in f]
+    nii_files += ["ses-{bids_age}/{file}".format(bids_age=bids_age, file=f) for f in sorted(outputs) if f.split(os.path.sep)[0] == "dwi" and f.endswith(".nii.gz")]
+
+    return json_files, nii_files
+
+class OutputPlan:
+    """Renames of the converter outputs of a session to their bids names. Before the conversions start, reserve() records
+    the files each series is expected to write. Once a series is converted, add() computes the renames of the files its
+    converter wrote (one listing of its staging directory), check() finds the collisions with the other series and with
+    the outputs of the manifest, and apply() renames them. For --dry_run, add() is called with the expected files.
+    With force (--force_convert), the outputs of the manifest entries that are not converted again are replaced too"""
+
+    def __init__(self, out_bids_sub_age, manifest=None, force=False):
+        self.out_bids_sub_age = out_bids_sub_age
+        self.manifest = manifest
+        self.force = force
+        self.jobs = []
+        self.renames = []
+        self.expected = {}
+        self.failed = set()
+        self.applied = set()
+        self.replaced = {}
+
+    def job_index(self, job):
+        for j, other in enumerate(self.jobs):
+            if other is job:
+                return j
+        self.jobs.append(job)
+        return len(self.jobs) - 1
+
+    def job_renames(self, j, job, names, bids_info):
+        # More than one file with the same extension gets a _<n> suffix, the conversion probably went wrong then
+        renames = []
+        count = {}
+
+        for name in sorted(names):
+
+            ext = output_ext(name)
+
+            bids_info_g = dict(bids_info)
+            bids_info_g['run_number'] = job['run_number']
+            bids_info_g['ext'] = ext
+
+            rename_file = job['rule']['out_name'].format(**bids_info_g)
+            if ext in count:
+                rename_file += "_{num}".format(num=count[ext])
+            count[ext] = count.get(ext, 0) + 1
+
+            renames.append({
+                'job': j,
+                'source': os.path.join(job['staging_dir'], name) if 'staging_dir' in job else name,
+                'target': os.path.join(job['out_bids_scan_dir'], rename_file),
+                'ext': ext,
+                'repeated': count[ext] > 1
+                })
+
+        return renames
+
+    def reserve(self, job, names, bids_info):
+        # Files the job is expected to write, so a series renamed before it is checked against them
+        j = self.job_index(job)
+        self.expected[j] = set(r['target'] for r in self.job_renames(j, job, names, bids_info))
+        return j
+
+    def add(self, job, names, bids_info):
+        """Add the renames of the files of a job, names are the file names in its staging directory. Returns the index
+        of the job in the plan"""
+
+        j = self.job_index(job)
+        self.renames += self.job_renames(j, job, names, bids_info)
+        return j
+
+    def outputs(self):
+        # Outputs of the session once the plan is applied, relative to the session directory: the planned targets and the
+        # outputs of the series converted by previous runs that are not converted again
+        keys = set(job['key'] for job in self.jobs)
+        outputs = set(os.path.relpath(r['target'], self.out_bids_sub_age) for j, r in self.planned())
+        if self.manifest is not None:
+            outputs |= set(output for key, entry in self.manifest.entries.items() if key not in keys for output in entry['outputs'])
+        return sorted(outputs)
+
+    def planned(self, jobs=None):
+        return [(r['job'], r) for r in self.renames if r['job'] not in self.failed and (jobs is None or r['job'] in jobs)]
+
+    def writers(self):
+        # Jobs writing each target: the renames of the converted jobs and the expected files of the others
+        added = set(r['job'] for r in self.renames)
+        writers = {}
+        for r in self.renames:
+            writers.setdefault(r['target'], set()).add(r['job'])
+        for j, targets in self.expected.items():
+            if j not in added:
+                for target in targets:
+                    writers.setdefault(target, set()).add(j)
+        return writers
+
+    def check(self, jobs=None):
+        """Find the targets of the jobs (all of them by default) written by more than one series, including the series not
+        converted yet, and the ones that are outputs of another series in the manifest that is not converted again.
+        The jobs involved that are not renamed yet are marked as failed. The outputs of a stale manifest entry (or of
+        any entry with force) are replaced instead, and the entry is removed once the job is renamed.
+        Returns the list of collisions and the list of existing files that will be replaced"""
+
+        collisions = []
+        overwrites = []
+
+        owners = {}
+        if self.manifest is not None:
+            owners = {os.path.join(self.out_bids_sub_age, output): key for key, entry in self.manifest.entries.items() for output in entry['outputs']}
+        keys = set(job['key'] for job in self.jobs)
+        writers = self.writers()
+
+        for target in sorted(set(r['target'] for r in self.renames if jobs is None or r['job'] in jobs)):
+
+            involved = sorted(writers[target])
+            owner = owners.get(target)
+
+            if len(involved) > 1:
+                collisions.append({'target': target, 'series': [self.jobs[j]['out_sd'] for j in involved], 'reason': 'written by more than one series'})
+                self.failed.update(j for j in involved if j not in self.applied)
+            elif owner is not None and owner not in keys and (self.force or self.manifest.stale(owner)):
+                overwrites.append({'target': target, 'reason': 'output of ' + owner + ', which is not converted again'})
+                self.replaced.setdefault(involved[0], set()).add(owner)
+            elif owner is not None and owner not in keys:
+                collisions.append({'target': target, 'series': [self.jobs[involved[0]]['out_sd']], 'reason': 'output of ' + owner})
+                self.failed.update(j for j in involved if j not in self.applied)
+            elif os.path.exists(target) and owner is None:
+                overwrites.append({'target': target, 'reason': 'not in the manifest'})
+
+        return collisions, overwrites
+
+    def apply(self, jobs=None):
+        """Rename the files of the jobs (all of them by default) that are not failed, the manifest entries whose outputs
+        they replace are removed. Returns the renamed targets of each job and the renames that failed"""
+
+        renamed = {j: [] for j in range(len(self.jobs)) if j not in self.failed and (jobs is None or j in jobs)}
+        errors = []
+
+        for j, r in self.planned(jobs):
+            try:
+                os.rename(r['source'], r['target'])
+                renamed[j].append(r['target'])
+            except OSError as e:
+                errors.append((r, e))
+
+        for j in renamed:
+            if len(renamed[j]) > 0:
+                for key in self.replaced.pop(j, set()):
+                    self.manifest.remove(key)
+
+        self.applied.update(renamed)
+        return renamed, errors
+
+    def lines(self):
+        # Text of the plan, one line per rename
+        return ["{source} -> {target}{failed}".format(source=os.path.basename(r['source']), target=os.path.relpath(r['target'], self.out_bids_sub_age), failed=" (collision, not renamed)" if r['job'] in self.failed else "") for r in self.renames]
@@ -0,0 +1,98 @@
+import contextlib
+import json
+import threading
+import time
+
+STAGES = ['dicom_dir_split', 'stream', 'convert', 'find_all_converted', 'generate_tsv', 'insert_intended_for_fmap', 'sidecars']
+
+class Metrics:
+    """Wall time, counters and subprocess durations of each stage of a subject.
+    Counters are free form (files, bytes, series etc.), subprocess calls can be recorded from several threads"""
+
+    def __init__(self, subject=None):
+        self.subject = subject
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'seconds': 0.0, 'counters': {}, 'subprocesses': []}
+        return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.get_stage(name)['seconds'] += time.perf_counter() - start
+
+    def count(self, stage, counter, value=1):
+        with self.lock:
+            counters = self.get_stage(stage)['counters']
+            counters[counter] = counters.get(counter, 0) + value
+
+    def subprocess(self, stage, cmd, seconds, returncode):
+        with self.lock:
+            self.get_stage(stage)['subprocesses'].append({'cmd': cmd, 'seconds': round(seconds, 4), 'returncode': returncode})
+
+    def to_dict(self):
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = {
+                'seconds': round(stage['seconds'], 4),
+                'counters': stage['counters'],
+                'subprocess_count': len(stage['subprocesses']),
+                'subprocess_seconds': round(sum(s['seconds'] for s in stage['subprocesses']), 4),
+                'subprocesses': stage['subprocesses']
+            }
+        return {'subject': self.subject, 'total_seconds': round(sum(s['seconds'] for s in stages.values()), 4), 'stages': stages}
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def table(self):
+        # Text table with one row per stage, used by --profile
+        lines = ["{:<26} {:>10} {:>8} {:>12}  {}".format('stage', 'seconds', 'calls', 'call_seconds', 'counters')]
+        for name, stage in self.to_dict()['stages'].items():
+            counters = ", ".join("{}={}".format(k, v) for k, v in sorted(stage['counters'].items()))
+            lines.append("{:<26} {:>10.3f} {:>8} {:>12.3f}  {}".format(name, stage['seconds'], stage['subprocess_count'], stage['subprocess_seconds'], counters))
+        return "\n".join(lines)
+
+def metrics_requested(args):
+    # Counters that cost extra file system calls (input_bytes) are only collected when the metrics are printed or saved
+    return bool(args.profile) or args.metrics_out is not None
+
+def summarize(metrics):
+    """Aggregate the metrics dictionaries of several subjects. For each stage it reports the total, mean and
+    max wall time, the subject with the max time and the sum of the counters"""
+
+    summary = {'subjects': len(metrics), 'total_seconds': round(sum(m['total_seconds'] for m in metrics), 4), 'stages': {}}
+
+    for name in STAGES + sorted(set(s for m in metrics for s in m['stages']) - set(STAGES)):
+        values = [(m['stages'][name], m['subject']) for m in metrics if name in m['stages']]
+        if len(values) == 0:
+            continue
+
+        seconds = [v['seconds'] for v, subject in values]
+        slowest = max(values, key=lambda v: v[0]['seconds'])
+
+        counters = {}
+        for v, subject in values:
+            for k, c in v['counters'].items():
+                counters[k] = counters.get(k, 0) + c
+
+        summary['stages'][name] = {
+            'subjects': len(values),
+            'total_seconds': round(sum(seconds), 4),
+            'mean_seconds': round(sum(seconds)/len(seconds), 4),
+            'max_seconds': round(max(seconds), 4),
+            'max_subject': slowest[1],
+            'subprocess_count': sum(v['subprocess_count'] for v, subject in values),
+            'subprocess_seconds': round(sum(v['subprocess_seconds'] for v, subject in values), 4),
+            'counters': counters
+        }
+
+    return summary
@@ -0,0 +1,245 @@
+import json
+import os
+import re
+from collections import OrderedDict
+
+from csv_rows import read_rows
+
+# Characters that are not matched literally by a pattern
+REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+
+def split_alternatives(pattern):
+    # Top level alternatives of a pattern, the | inside groups and character classes are kept
+    alternatives = ['']
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            alternatives[-1] += pattern[i:i + 2]
+            i += 2
+            continue
+        if c == '[':
+            end = class_end(pattern, i)
+            alternatives[-1] += pattern[i:end]
+            i = end
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            alternatives.append('')
+            i += 1
+            continue
+        alternatives[-1] += c
+        i += 1
+    return alternatives
+
+def class_end(pattern, i):
+    # Index after the character class that starts at pattern[i] == '['
+    j = i + 1
+    if j < len(pattern) and pattern[j] == '^':
+        j += 1
+    if j < len(pattern) and pattern[j] == ']':
+        j += 1
+    while j < len(pattern) and pattern[j] != ']':
+        j += 2 if pattern[j] == '\\' else 1
+    return j + 1
+
+def group_end(pattern, i):
+    # Index after the group that starts at pattern[i] == '('
+    depth = 0
+    j = i
+    while j < len(pattern):
+        c = pattern[j]
+        if c == '\\':
+            j += 2
+            continue
+        if c == '[':
+            j = class_end(pattern, j)
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                return j + 1
+        j += 1
+    return j
+
+def required_literals(pattern):
+    """Lowercase strings that a string matching the pattern must contain, one set for each top level alternative.
+    Only the literal runs outside groups and the ones in positive lookaheads (?=.*dwi) or plain groups are taken,
+    anything not understood is left out so a string can miss a literal only if the pattern cannot match it.
+    Returns None if some alternative has no required literal"""
+
+    alternatives = []
+
+    for alternative in split_alternatives(pattern):
+
+        literals = set()
+        run = ''
+        i = 0
+
+        while i < len(alternative):
+            c = alternative[i]
+
+            if c in '*?{+':
+                # The previous character or group is optional or repeated
+                run = run[:-1]
+                literals.add(run)
+                run = ''
+                i = alternative.find('}', i) + 1 if c == '{' and '}' in alternative[i:] else i + 1
+                continue
+
+            literals.add(run)
+            run = ''
+
+            if c == '(':
+                end = group_end(alternative, i)
+                quantified = end < len(alternative) and alternative[end] in '*?{'
+                inner = None
+                if alternative.startswith('(?=', i):
+                    inner = alternative[i + 3:end - 1]
+                elif not alternative.startswith('(?', i):
+                    inner = alternative[i + 1:end - 1]
+                elif alternative.startswith('(?:', i):
+                    inner = alternative[i + 3:end - 1]
+                if inner is not None and not quantified:
+                    inner_literals = required_literals(inner)
+                    if inner_literals is not None and len(inner_literals) == 1:
+                        literals |= inner_literals[0]
+                i = end
+            elif c == '[':
+                i = class_end(alternative, i)
+            elif c == '\\':
+                i += 2
+            elif c in REGEX_SPECIAL:
+                i += 1
+            else:
+                run = c
+                i += 1
+                while i < len(alternative) and alternative[i] not in REGEX_SPECIAL:
+                    run += alternative[i]
+                    i += 1
+
+        literals.add(run)
+        literals = set(literal.lower() for literal in literals if literal != '' and literal.isascii())
+
+        if len(literals) == 0:
+            return None
+        alternatives.append(literals)
+
+    return alternatives
+
+class ScanMatcher:
+    """Compiled version of the rules in pattern_search_scans.csv.
+    The rules are ordered by scan and then by their position in the csv file, the same order used when the
+    table is grouped by scan. Each series description is matched against all the rules in a single pass.
+    The rules whose required literals (see required_literals) are not in the description are not evaluated, and the
+    result of the last cache_size descriptions is kept, the same descriptions repeat across the series of a cohort"""
+
+    def __init__(self, rows, cache_size=4096, prefilter=True):
+
+        self.rules = []
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.prefilter = prefilter
+        self.hits = 0
+        self.misses = 0
+
+        # rows are the rows of pattern_search_scans.csv as dictionaries (see csv_rows.read_rows), the index of a rule is
+        # its position in the file
+        for idx, row in enumerate(rows):
+            add_json = None
+            if row['add_json'] != '':
+                add_json = json.loads(row['add_json'])
+
+            self.rules.append({
+                'index': idx,
+                'scan': row['scan'],
+                'match': row['match'],
+                'regex': re.compile(row['match'], re.IGNORECASE),
+                'out_name': row['out_name'],
+                'add_json': add_json,
+                'literals': required_literals(row['match']) if prefilter else None
+                })
+
+        self.rules.sort(key=lambda rule: (rule['scan'], rule['index']))
+
+        self.scans = sorted(set(rule['scan'] for rule in self.rules))
+        self.literals = sorted(set(literal for rule in self.rules if rule['literals'] is not None for alternative in rule['literals'] for literal in alternative))
+
+    def candidates(self, sd):
+        # Rules that can match the description. With IGNORECASE some non ascii characters match ascii letters, the
+        # literals are only checked on ascii descriptions
+        if not self.prefilter or not sd.isascii():
+            return self.rules
+        sd_lower = sd.lower()
+        present = set(literal for literal in self.literals if literal in sd_lower)
+        return [rule for rule in self.rules if rule['literals'] is None or any(alternative <= present for alternative in rule['literals'])]
+
+    def match(self, sd):
+        # Returns all the rules that match the series description, the returned list is shared and must not be changed
+        if sd in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(sd)
+            return self.cache[sd]
+
+        self.misses += 1
+        matches = [rule for rule in self.candidates(sd) if rule['regex'].match(sd)]
+
+        if self.cache_size > 0:
+            self.cache[sd] = matches
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return matches
+
+    def classify(self, series_description):
+        """Match all the series and return a dictionary with the matching rules of each series,
+        the series that match more than one rule and the ones that do not match any"""
+
+        matches = {}
+        ambiguous = []
+        unmatched = []
+
+        for sn_sd in sorted(series_description):
+            matches[sn_sd] = self.match(series_description[sn_sd])
+            if len(matches[sn_sd]) == 0:
+                unmatched.append(sn_sd)
+            elif len(matches[sn_sd]) > 1:
+                ambiguous.append(sn_sd)
+
+        return {'matches': matches, 'ambiguous': ambiguous, 'unmatched': unmatched}
+
+    def plan(self, classification):
+        """Returns the list of (rule, sn_sd, run_number) to convert from the output of classify. The run number of each
+        rule starts at 1 and follows the series number order. The list is ordered by rule and then by series"""
+
+        run_numbers = {}
+        plan = []
+
+        for sn_sd in sorted(classification['matches']):
+            for rule in classification['matches'][sn_sd]:
+                run_number = run_numbers.get(rule['index'], 1)
+                run_numbers[rule['index']] = run_number + 1
+                plan.append((rule, sn_sd, run_number))
+
+        order = {rule['index']: i for i, rule in enumerate(self.rules)}
+        plan.sort(key=lambda p: order[p[0]['index']])
+
+        return plan
+
+# Matchers of the processes, so the subjects of a --csv file run by the same process share the cache
+shared_matchers = {}
+
+def shared_matcher(filename, cache_size=4096):
+    """ScanMatcher of the pattern file, built once per process and built again if the file changes"""
+
+    key = (os.path.abspath(filename), os.path.getmtime(filename), cache_size)
+    if key not in shared_matchers:
+        shared_matchers.clear()
+        shared_matchers[key] = ScanMatcher(read_rows(filename), cache_size=cache_size)
+    return shared_matchers[key]
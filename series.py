@@ -0,0 +1,89 @@
+class SeriesRecord:
+    """Compact description of a series built once during the split. It keeps what the later stages need
+    (tsv, IntendedFor, --generate_tsv 2) so none of them has to open the dicoms again. The outputs and
+    the main converted image are filled by the conversion or loaded from the conversion manifest. duplicates has the
+    (duplicate, file kept) pairs of the files dropped because they repeat the SOPInstanceUID of another file"""
+
+    __slots__ = ['series_number', 'series_description', 'series_uid', 'acquisition_date', 'acquisition_time', 'file_count', 'outputs', 'converted', 'duplicates']
+
+    def __init__(self, series_number, series_description, series_uid=None, acquisition_date=None, acquisition_time=None, file_count=0):
+        self.series_number = series_number
+        self.series_description = series_description
+        self.series_uid = series_uid
+        self.acquisition_date = acquisition_date
+        self.acquisition_time = acquisition_time
+        self.file_count = file_count
+        self.outputs = []
+        self.converted = None
+        self.duplicates = []
+
+    @classmethod
+    def from_header(cls, header, file_count):
+        return cls(header['SeriesNumber'], header['SeriesDescription'], header.get('SeriesInstanceUID'), header.get('AcquisitionDate'), header.get('AcquisitionTime'), file_count)
+
+    @classmethod
+    def from_sidecar(cls, sidecar):
+        # Used for series converted by a previous run that are not in the current split. dcm2niix writes the
+        # AcquisitionTime as HH:MM:SS.ffffff and usually no date
+        acquisition_date = None
+        acquisition_time = sidecar.get('AcquisitionTime')
+        if 'AcquisitionDateTime' in sidecar:
+            acquisition_date, acquisition_time = sidecar['AcquisitionDateTime'].split('T', 1)
+        if acquisition_date is not None:
+            acquisition_date = acquisition_date.replace('-', '')
+        if acquisition_time is not None:
+            acquisition_time = acquisition_time.replace(':', '')
+        return cls(sidecar['SeriesNumber'], sidecar['SeriesDescription'], sidecar.get('SeriesInstanceUID'), acquisition_date, acquisition_time)
+
+    @property
+    def sn_sd(self):
+        return (self.series_number, self.series_description)
+
+    def acq_time(self, default_date=None):
+        """Acquisition date and time formatted for the scans.tsv file, YYYY-MM-DDTHH:MM:SS.
+        default_date (YYYYMMDD) is used when the record has no date"""
+
+        acquisition_date = self.acquisition_date or default_date or ''
+        acquisition_time = self.acquisition_time or ''
+
+        acquisition_date = '-'.join([acquisition_date[0:4], acquisition_date[4:6], acquisition_date[6:]])
+        acquisition_time = ':'.join([acquisition_time[0:2], acquisition_time[2:4], acquisition_time[4:6]])
+
+        return "{acquisition_date}T{acquisition_time}".format(acquisition_date=acquisition_date, acquisition_time=acquisition_time)
+
+def session_date(series_records):
+    # All the series of a session share the date, the first one found is used for records without date
+    for sn_sd in sorted(series_records):
+        if series_records[sn_sd].acquisition_date:
+            return series_records[sn_sd].acquisition_date
+    return None
+
+def load_manifest_records(series_records, manifest):
+    """Add the outputs recorded in the conversion manifest to the records. Series that are in the manifest
+    but not in the current split get a record too, without acquisition information"""
+
+    for key, entry in sorted(manifest.entries.items()):
+
+        sn_sd = (entry['series_number'], entry['series_description'])
+
+        if sn_sd not in series_records:
+            series_records[sn_sd] = SeriesRecord(entry['series_number'], entry['series_description'], key.split('|')[0])
+
+        record = series_records[sn_sd]
+        for output in entry['outputs']:
+            if output not in record.outputs:
+                record.outputs.append(output)
+        if record.converted is None and entry['converted'] is not None:
+            record.converted = entry['converted']
+
+    return series_records
+
+def duplicate_report(series_records):
+    # Series that had files dropped as duplicates, with the files dropped and the ones kept
+    report = []
+    for sn_sd in sorted(series_records):
+        record = series_records[sn_sd]
+        if len(record.duplicates) > 0:
+            report.append({'series_number': record.series_number, 'series_description': record.series_description, 'files': record.file_count,
+                'duplicates': [{'file': duplicate, 'duplicate_of': kept} for duplicate, kept in record.duplicates]})
+    return report
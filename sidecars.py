@@ -0,0 +1,45 @@
+import json
+import os
+
+class SidecarStore:
+    """JSON sidecars of a session. Each file is read once, the edits (add_json of the patterns, IntendedFor etc.) are
+    applied to the loaded dictionary and the file is written once by flush, to a temporary file first that then replaces
+    the sidecar so it is never left half written. reads and writes count the files read and written"""
+
+    def __init__(self):
+        self.sidecars = {}
+        self.modes = {}
+        self.dirty = set()
+        self.reads = 0
+        self.writes = 0
+
+    def get(self, filename):
+        if filename not in self.sidecars:
+            with open(filename) as f:
+                self.sidecars[filename] = json.load(f)
+            self.reads += 1
+        return self.sidecars[filename]
+
+    def update(self, filename, fields, mode=None):
+        # mode is the permission of the written file, by default the one of the current file
+        self.get(filename).update(fields)
+        self.dirty.add(filename)
+        if mode is not None:
+            self.modes[filename] = mode
+
+    def flush(self, filenames=None):
+        """Write the edited sidecars, all of them or the ones in filenames. The written sidecars are dropped from memory"""
+
+        if filenames is None:
+            filenames = self.dirty
+
+        for filename in sorted(set(filenames) & self.dirty):
+            tmp = filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.sidecars[filename], f, indent=4, sort_keys=True)
+            os.chmod(tmp, self.modes.pop(filename, os.stat(filename).st_mode & 0o7777))
+            os.replace(tmp, filename)
+
+            self.writes += 1
+            self.dirty.discard(filename)
+            del self.sidecars[filename]